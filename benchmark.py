@@ -0,0 +1,297 @@
+# Benchmark of the data and render pipeline of the webapp, run headless (no streamlit server).
+# Every stage the app goes through (csv parse, parquet cache, outlier filter, cube aggregates, hover text, figure
+# build and serialization, the pipeline LOD and the spatial indexes) is timed on the incident data scaled 1x, 10x
+# and 100x, with the peak RSS and the payload bytes sent to the browser. The results can be saved as a baseline and
+# later runs are compared against it:
+#
+#   python benchmark.py --save-baseline          # on the main branch
+#   python benchmark.py                          # on a change, exits with 1 when a stage regressed
+#   python benchmark.py --scales 1 --profile cube  # cProfile of the stages matching 'cube'
+
+import argparse
+import cProfile
+import csv
+import gzip
+import json
+import os
+import pstats
+import random
+import resource
+import shutil
+import tempfile
+import threading
+import time
+
+import pandas as pd
+
+import cube
+import figure_store
+import figures
+import geo_lod
+import incidents
+import ingest
+import schema
+import spatial
+
+TRANS_INCIDENTS = ('data/incident_gas_transmission_gathering_jan2010_present.csv', 'data/Gas_Trans_required_columns.txt')
+DIST_INCIDENTS = ('data/incident_gas_distribution_jan2010_present.csv', 'data/Gas_Dist_required_columns.txt')
+GEO_DF = 'geo_df.pkl'
+GEO_DF_TRANS = 'geo_df_trans.pkl'
+
+SCALES = [1, 10, 100]
+SYNTHETIC_DIR = os.path.join(ingest.CACHE_DIR, 'benchmark')
+SYNTHETIC_REPORT_OFFSET = 10**8 # added to the report numbers of each copy, so they stay unique
+SYNTHETIC_JITTER = 0.05 # degrees, the copies of an incident are moved around it a little
+BASELINE = 'benchmark_baseline.json'
+
+# A stage regressed when it is slower/bigger than the baseline by more than the tolerance and by more than the
+# noise floor, short stages jitter by a few milliseconds between runs
+TOLERANCE = 0.25
+MIN_WALL_DELTA = 0.005 # seconds
+MIN_RSS_DELTA = 20 # MB
+RSS_SAMPLE_INTERVAL = 0.002 # seconds
+
+
+def synthetic_csv(src, scale, out_dir=SYNTHETIC_DIR):
+    '''The incident csv with every row repeated scale times, written once and reused.
+
+    The copies get new report numbers and their locations are jittered, so the indexes and the map have distinct
+    points to work with. The raw rows are copied as text, the csv doesn't have to fit in memory as a frame.
+    '''
+    if scale == 1:
+        return src
+    stem = os.path.splitext(os.path.basename(src))[0]
+    path = os.path.join(out_dir, '%s_x%d.csv' % (stem, scale))
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(src):
+        return path
+    os.makedirs(out_dir, exist_ok=True)
+    with open(src, newline='', encoding='utf-8') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        rows = list(reader)
+    report = header.index('REPORT_NUMBER')
+    coords = [header.index('LOCATION_LATITUDE'), header.index('LOCATION_LONGITUDE')]
+    rng = random.Random(scale)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        for copy in range(scale):
+            for row in rows:
+                if copy:
+                    row = list(row)
+                    row[report] = str(int(row[report]) + copy*SYNTHETIC_REPORT_OFFSET)
+                    for i in coords:
+                        if row[i]:
+                            row[i] = '%.6f' % (float(row[i]) + rng.uniform(-SYNTHETIC_JITTER, SYNTHETIC_JITTER))
+                writer.writerow(row)
+    os.replace(tmp_path, path)
+    return path
+
+
+def _rss_mb():
+    # resident set size of the process, /proc is only there on linux
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')/2**20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+
+
+class _PeakRSS:
+    '''Samples the RSS in a background thread while a stage runs and keeps the highest value.'''
+
+    def __enter__(self):
+        self.peak = _rss_mb()
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def _sample(self):
+        while not self._done.wait(RSS_SAMPLE_INTERVAL):
+            self.peak = max(self.peak, _rss_mb())
+
+    def __exit__(self, *exc):
+        self._done.set()
+        self._thread.join()
+        self.peak = max(self.peak, _rss_mb())
+
+
+class Bench:
+    '''Runs the stages and collects their results, keyed by 'x<scale>/<stage>'.'''
+
+    def __init__(self, repeat=1, profile=None):
+        self.repeat = repeat
+        self.profile = profile
+        self.results = {}
+
+    def stage(self, key, fn, *args, payload=None):
+        '''Runs fn(*args) repeat times, records the best wall time and the peak RSS, returns the result of fn.
+
+        payload maps the result to the number of bytes it puts on the wire, if it's something that is sent.
+        '''
+        best = float('inf')
+        with _PeakRSS() as rss:
+            for _ in range(self.repeat):
+                start = time.perf_counter()
+                result = fn(*args)
+                best = min(best, time.perf_counter() - start)
+        record = {'wall_s': best, 'peak_rss_mb': rss.peak}
+        if payload:
+            record['payload_bytes'] = payload(result)
+        self.results[key] = record
+        print('%-55s %9.1f ms %8.0f MB %s' % (key, best*1000, rss.peak,
+                                            '%10d B' % record['payload_bytes'] if payload else ''))
+        if self.profile and self.profile in key:
+            profiler = cProfile.Profile()
+            profiler.runcall(fn, *args)
+            pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
+        return result
+
+
+def _unmemoized(query, incident_cube, dataset):
+    incident_cube._answers.clear()
+    return query(incident_cube, dataset)
+
+
+def _serialize(fig):
+    return figure_store.StoredFigure(figure_store.serialize(fig))
+
+
+def _payload(stored):
+    return stored.size
+
+
+def figure_stages(bench, prefix, name, build, *args):
+    '''Builds a figure and serializes it the way the figure store does, as two stages.'''
+    fig = bench.stage('%s/fig_%s_build' % (prefix, name), build, *args)
+    stored = bench.stage('%s/fig_%s_serialize' % (prefix, name), _serialize, fig, payload=_payload)
+    # about what the websocket compression sends
+    bench.results['%s/fig_%s_serialize' % (prefix, name)]['gzip_bytes'] = len(gzip.compress(stored.spec.encode(), 6))
+    return stored
+
+
+def incident_stages(bench, scale, segments):
+    prefix = 'x%d' % scale
+    frames = {}
+    cache_dir = tempfile.mkdtemp(prefix='benchmark-')
+    try:
+        for name, (csv_path, columns_path) in [('transmission', TRANS_INCIDENTS), ('distribution', DIST_INCIDENTS)]:
+            src = synthetic_csv(csv_path, scale)
+            columns = ingest.stored_columns(ingest.read_required_columns(columns_path))
+            # the first visit parses the csv into the parquet cache, the next ones only read the cache
+            df = bench.stage('%s/%s_csv_parse' % (prefix, name), ingest.parse_csv, src, columns)
+            parquet_path = os.path.join(cache_dir, name + '.parquet')
+            bench.stage('%s/%s_parquet_write' % (prefix, name), df.to_parquet, parquet_path)
+            bench.stage('%s/%s_parquet_read' % (prefix, name),
+                        lambda: schema.apply_schema(pd.read_parquet(parquet_path, columns=columns)))
+            frames[name] = bench.stage('%s/%s_filter_continental' % (prefix, name), incidents.filter_continental, df)
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    incident_cube = bench.stage(prefix + '/cube_build', cube.Cube, frames)
+    # the aggregates, the memoized answers are dropped before each run so they don't hide the query
+    for dataset in ['transmission', 'distribution']:
+        for query in [incidents.year_state_counts, incidents.cause_counts, incidents.casualty_totals,
+                      incidents.casualties_by_state]:
+            bench.stage('%s/%s_%s' % (prefix, dataset, query.__name__), _unmemoized, query, incident_cube, dataset)
+
+    trans_year_state = incidents.year_state_counts(incident_cube, 'transmission')
+    acc_cause = incidents.cause_counts(incident_cube, 'transmission')
+    dist_year_state = incidents.year_state_counts(incident_cube, 'distribution')
+    by_state = incidents.casualties_by_state(incident_cube, 'distribution')
+    dist = frames['distribution']
+    text = bench.stage(prefix + '/hover_text', incidents.hover_text, dist)
+
+    figure_stages(bench, prefix, 'transmission_year_state', figures.transmission_year_state_bar, trans_year_state)
+    figure_stages(bench, prefix, 'cause_bar', figures.cause_bar, acc_cause)
+    figure_stages(bench, prefix, 'cause_pie', figures.cause_pie, acc_cause)
+    figure_stages(bench, prefix, 'incident_map', figures.incident_map, dist, text)
+    # the zoomed out incident map bins the incidents once there are more than incidents.MAX_MAP_POINTS
+    bins = bench.stage(prefix + '/incident_bins', incidents.binned, dist,
+                       incidents.bin_size(geo_lod.VIEWS[geo_lod.FULL_VIEW]))
+    figure_stages(bench, prefix, 'incident_density_map', figures.incident_density_map, bins)
+    figure_stages(bench, prefix, 'distribution_year_state', figures.distribution_year_state_bar, dist_year_state)
+    figure_stages(bench, prefix, 'year_state_choropleth', figures.year_state_choropleth, dist_year_state)
+    figure_stages(bench, prefix, 'casualties_bar', figures.casualties_bar, by_state)
+    figure_stages(bench, prefix, 'casualties_choropleth', figures.casualties_choropleth,
+                  incidents.casualties_per_state(by_state))
+
+    geo_df_trans, trans_lod, segment_index = segments
+    points = bench.stage(prefix + '/point_index_build', spatial.PointIndex,
+                         dist['LOCATION_LONGITUDE'], dist['LOCATION_LATITUDE'])
+    near = bench.stage(prefix + '/near_pipelines', incidents.near_pipelines, dist, points, segment_index,
+                       geo_df_trans, geo_lod.VIEWS[geo_lod.FULL_VIEW], 10)
+    figure_stages(bench, prefix, 'nearby_incidents_map', figures.nearby_incidents_map,
+                  near, trans_lod.for_view(geo_lod.FULL_VIEW))
+
+
+def segment_stages(bench):
+    '''The pipeline map stages, on the full segment pickles.'''
+    prefix = 'segments'
+    geo_df = bench.stage(prefix + '/geo_df_load', lambda: schema.compact_segments(pd.read_pickle(GEO_DF)))
+    geo_df_trans = bench.stage(prefix + '/geo_df_trans_load', lambda: schema.compact_segments(pd.read_pickle(GEO_DF_TRANS)))
+    lod = bench.stage(prefix + '/geo_df_lod_build', geo_lod.PipelineLOD, geo_df)
+    trans_lod = bench.stage(prefix + '/geo_df_trans_lod_build', geo_lod.PipelineLOD, geo_df_trans)
+    for view in geo_lod.VIEWS:
+        key = view.lower().replace(' ', '_')
+        lines = bench.stage('%s/lod_for_view_%s' % (prefix, key), lambda: (lod.for_view(view), trans_lod.for_view(view)))
+        figure_stages(bench, prefix, 'pipeline_map_' + key, figures.pipeline_map, *lines, view != geo_lod.FULL_VIEW)
+    segment_index = bench.stage(prefix + '/segment_index_build', spatial.SegmentIndex, geo_df_trans)
+    return geo_df_trans, trans_lod, segment_index
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    '''The stages that got slower, bigger or sent more bytes than in the baseline.'''
+    regressions = []
+    for key, now in results.items():
+        before = baseline.get(key)
+        if not before:
+            continue
+        checks = [('wall_s', MIN_WALL_DELTA), ('peak_rss_mb', MIN_RSS_DELTA), ('payload_bytes', 0)]
+        for measure, floor in checks:
+            if measure in now and measure in before:
+                if now[measure] > before[measure]*(1 + tolerance) and now[measure] - before[measure] > floor:
+                    regressions.append((key, measure, before[measure], now[measure]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the data and render stages of the webapp.')
+    parser.add_argument('--scales', type=int, nargs='+', default=SCALES, help='incident data scale factors')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per stage, the best time is kept')
+    parser.add_argument('--baseline', default=BASELINE, help='json file with the results to compare against')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help='allowed slowdown/growth, 0.25 is 25%%')
+    parser.add_argument('--profile', metavar='STAGE', help='print a cProfile of the stages whose name contains STAGE')
+    parser.add_argument('--output', help='also write the results to this json file')
+    args = parser.parse_args()
+
+    bench = Bench(args.repeat, args.profile)
+    print('%-55s %12s %11s %12s' % ('stage', 'wall', 'peak RSS', 'payload'))
+    segments = segment_stages(bench)
+    for scale in args.scales:
+        incident_stages(bench, scale, segments)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(bench.results, f, indent=1, sort_keys=True)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(bench.results, f, indent=1, sort_keys=True)
+        print('baseline saved to %s' % args.baseline)
+        return 0
+    if not os.path.exists(args.baseline):
+        print('no baseline at %s, run with --save-baseline to store one' % args.baseline)
+        return 0
+    with open(args.baseline) as f:
+        regressions = compare(bench.results, json.load(f), args.tolerance)
+    for key, measure, before, now in regressions:
+        print('REGRESSION %s %s: %.4g -> %.4g' % (key, measure, before, now))
+    print('%d regressions against %s' % (len(regressions), args.baseline))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,325 @@
+# Converts the pipeline shape files in data/mapping into the segment pickles loaded by the webapp
+# (geo_df.pkl, geo_df_trans.pkl, geo_df_mx.pkl): lat/lon columns with a None row after each line, the way px.line_geo
+# expects them, plus the operator/pipe name and category of each line.
+#
+# The .shp/.shx/.dbf files are read directly into numpy arrays, the coordinates are reprojected to WGS84 with pyproj
+# and the lines are clipped to the USA states. Each output is only rebuilt when its source files change and the
+# outputs are converted in parallel.
+#
+#   python convert_shapefiles.py            # rebuild the outputs whose shape files changed
+#   python convert_shapefiles.py --force geo_df_trans.pkl
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from pyproj import CRS, Transformer
+
+MAPPING_DIR = os.path.join('data', 'mapping')
+MANIFEST = os.path.join('data', 'cache', 'segments.json')
+PICKLE_PROTOCOL = 4 # fixed so the pickles are byte for byte reproducible
+
+# The lines are clipped to the USA states (the map only covers the USA), set 'clip' to None in a source to keep everything
+CLIP_SHAPEFILE = 'usa-states-census-2014'
+LAT_BAND = 0.5 # degrees, the polygon edges are bucketed in latitude bands for the point in polygon test
+
+# output pickle -> shape file, dbf field -> output column, and the category for sources without a category field
+SOURCES = {
+    'geo_df.pkl': {'shapefile': 'NaturalGas_Pipelines_US_202001',
+                   'fields': {'Operator': 'Operator_Name', 'TYPEPIPE': 'Category'},
+                   'clip': CLIP_SHAPEFILE},
+    'geo_df_trans.pkl': {'shapefile': 'HGL_Pipelines_US_202001',
+                         'fields': {'Pipename': 'Pipe_Name', 'Opername': 'Operator_Name'},
+                         'category': 'Major Gas Transmission Pipeline',
+                         'clip': CLIP_SHAPEFILE},
+    # offshore, so not clipped to the states
+    'geo_df_mx.pkl': {'shapefile': 'ppl_arcs',
+                      'fields': {'SDE_COMPAN': 'Operator_Name'},
+                      'category': 'Gulf of Mexico Pipeline',
+                      'clip': None},
+}
+SHAPEFILE_EXTENSIONS = ['.shp', '.shx', '.dbf', '.prj', '.cpg']
+
+# (Poly)Line and Polygon shape types with their Z and M variants, the z/m values come after the x/y points
+POLYLINE_TYPES = (3, 13, 23)
+POLYGON_TYPES = (5, 15, 25)
+
+
+def _gather(buf, starts, counts, size, dtype):
+    '''Reads counts[i] values of the given size starting at byte starts[i] of buf, for all i at once.'''
+    total = int(counts.sum())
+    if not total:
+        return np.array([], dtype=dtype)
+    first = np.repeat(starts - np.r_[0, np.cumsum(counts)[:-1]]*size, counts)
+    byte_idx = (first + np.arange(total)*size)[:, None] + np.arange(size)
+    return buf[byte_idx.ravel()].view(dtype)
+
+
+def read_shp(path, shape_types=POLYLINE_TYPES):
+    '''Points and parts of a polyline (or polygon) shape file.
+
+    Returns the x and y of all the points, the index of the first point of each part and the record of each part.
+    '''
+    with open(path + '.shx', 'rb') as f:
+        index = np.frombuffer(f.read()[100:], dtype='>i4').reshape(-1, 2).astype(np.int64)*2 # offset, length in bytes
+    with open(path + '.shp', 'rb') as f:
+        buf = np.frombuffer(f.read(), dtype=np.uint8)
+
+    content = index[:, 0] + 8 # skip the record header
+    shape_type = _gather(buf, content, np.ones(len(content), dtype=np.int64), 4, '<i4')
+    records = np.flatnonzero(shape_type != 0) # null shapes have no geometry
+    if not np.isin(shape_type[records], shape_types).all():
+        raise ValueError('%s has unexpected shape types %s' % (path, sorted(set(shape_type[records]))))
+    content = content[records]
+
+    counts = _gather(buf, content + 36, np.full(len(content), 2), 4, '<i4').reshape(-1, 2).astype(np.int64)
+    num_parts, num_points = counts[:, 0], counts[:, 1]
+    parts = _gather(buf, content + 44, num_parts, 4, '<i4').astype(np.int64)
+    xy = _gather(buf, content + 44 + 4*num_parts, 2*num_points, 8, '<f8').reshape(-1, 2)
+
+    # part starts are relative to their record, shift them by the points of the previous records
+    part_record = np.repeat(np.arange(len(records)), num_parts)
+    part_starts = parts + np.r_[0, np.cumsum(num_points)[:-1]][part_record]
+    return xy[:, 0], xy[:, 1], part_starts, records[part_record]
+
+
+def read_dbf(path, fields, encoding='utf-8'):
+    '''The given fields of a dbf file as a dataframe, one row per record.'''
+    with open(path + '.dbf', 'rb') as f:
+        data = f.read()
+    num_records = int.from_bytes(data[4:8], 'little')
+    header_len = int.from_bytes(data[8:10], 'little')
+    dtype, kinds = [('deleted', 'S1')], {}
+    for i in range(32, header_len - 1, 32):
+        name = data[i:i+11].split(b'\0')[0].decode('ascii')
+        kinds[name] = chr(data[i+11])
+        dtype.append((name, 'S%d' % data[i+16]))
+    table = np.frombuffer(data, dtype=np.dtype(dtype), count=num_records, offset=header_len)
+
+    columns = {}
+    for name in fields:
+        values = pd.Series(table[name]).str.decode(encoding).str.strip()
+        if kinds[name] in 'NF':
+            values = pd.to_numeric(values, errors='coerce')
+        else:
+            values[values == ''] = None
+        columns[name] = values
+    return pd.DataFrame(columns)
+
+
+def to_wgs84(x, y, prj_path):
+    '''Reprojects the points from the coordinate system in the .prj file to WGS84 lon/lat.'''
+    with open(prj_path) as f:
+        crs = CRS.from_wkt(f.read())
+    wgs84 = CRS.from_epsg(4326)
+    if crs == wgs84:
+        return x, y
+    return Transformer.from_crs(crs, wgs84, always_xy=True).transform(x, y)
+
+
+def polygon_edges(shapefile):
+    '''Edges (x0, y0, x1, y1, polygon) of all the rings of a polygon shape file, in WGS84 lon/lat.'''
+    path = os.path.join(MAPPING_DIR, shapefile)
+    x, y, ring_starts, ring_record = read_shp(path, POLYGON_TYPES)
+    x, y = to_wgs84(x, y, path + '.prj')
+    x, y = np.asarray(x), np.asarray(y)
+    # an edge from each point to the next one, except from the last point of a ring to the first of the next
+    last = np.zeros(len(x), dtype=bool)
+    last[np.r_[ring_starts[1:], len(x)] - 1] = True
+    start = np.flatnonzero(~last)
+    ring = np.searchsorted(ring_starts, start, side='right') - 1
+    return x[start], y[start], x[start + 1], y[start + 1], ring_record[ring]
+
+
+def inside_polygons(px, py, edges):
+    '''Even-odd point in polygon test of all the points against all the polygons at once.
+
+    A point is inside if it is inside any of the polygons, the states file has some states twice.
+    '''
+    x0, y0, x1, y1, polygon = edges
+    inside = np.zeros(len(px), dtype=bool)
+    band = np.floor(py/LAT_BAND).astype(int)
+    edge_lo, edge_hi = np.floor(np.minimum(y0, y1)/LAT_BAND), np.floor(np.maximum(y0, y1)/LAT_BAND)
+    # only the edges spanning a band can cross the horizontal ray of a point in it
+    for b in np.unique(band):
+        points = np.flatnonzero(band == b)
+        e = np.flatnonzero((edge_lo <= b) & (b <= edge_hi))
+        qx, qy = px[points, None], py[points, None]
+        spans = (y0[e] > qy) != (y1[e] > qy)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cross_x = x0[e] + (qy - y0[e])*(x1[e] - x0[e])/(y1[e] - y0[e])
+        # crossings per point and polygon, through a one hot matrix of the polygon of each edge
+        polygons, edge_polygon = np.unique(polygon[e], return_inverse=True)
+        one_hot = np.zeros((len(e), len(polygons)))
+        one_hot[np.arange(len(e)), edge_polygon] = 1
+        crossings = (spans & (qx < cross_x)).astype(float) @ one_hot
+        inside[points] = (crossings % 2 == 1).any(axis=1)
+    return inside
+
+
+def border_crossing(ax, ay, bx, by, edges):
+    '''Point where the segment from a to b crosses a polygon edge, nearest to a (a is the point inside).'''
+    x0, y0, x1, y1, _ = edges
+    dx, dy, ex, ey = bx - ax, by - ay, x1 - x0, y1 - y0
+    denom = dx*ey - dy*ex
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = ((x0 - ax)*ey - (y0 - ay)*ex)/denom # along the segment
+        u = ((x0 - ax)*dy - (y0 - ay)*dx)/denom # along the edge
+    t = t[(denom != 0) & (0 <= t) & (t <= 1) & (0 <= u) & (u <= 1)]
+    t = t.min() if len(t) else 0.5 # no edge found (numerical corner case), use the midpoint
+    return ax + t*dx, ay + t*dy
+
+
+def clip(lons, lats, part_of_point, edges):
+    '''Clips the lines to the polygons.
+
+    Returns the lon, lat and part of the points that remain (with a point added where a line crosses the border)
+    and a run number for each of them, every run becomes a separate line.
+    '''
+    inside = inside_polygons(lons, lats, edges)
+    same_part = part_of_point[1:] == part_of_point[:-1]
+    flips = np.flatnonzero(same_part & (inside[1:] != inside[:-1]))
+
+    # a run starts at the first point of each part and where a line comes back inside
+    starts = np.r_[True, ~same_part] | (inside & np.r_[False, ~inside[:-1]])
+    run = np.cumsum(starts)
+
+    kept = np.flatnonzero(inside)
+    xs, ys, keys, runs = [lons[kept]], [lats[kept]], [kept.astype(float)], [run[kept]]
+    for i in flips:
+        a, b = (i, i + 1) if inside[i] else (i + 1, i)
+        x, y = border_crossing(lons[a], lats[a], lons[b], lats[b], edges)
+        xs.append([x])
+        ys.append([y])
+        keys.append([i + 0.5])
+        runs.append([run[a]])
+    order = np.argsort(np.concatenate(keys), kind='stable')
+    keys = np.concatenate(keys)[order]
+    part = part_of_point[np.floor(keys).astype(int)]
+    return np.concatenate(xs)[order], np.concatenate(ys)[order], part, np.concatenate(runs)[order]
+
+
+def segments(shapefile, fields, category=None, clip_to=None):
+    '''Segment frame of a shape file: a row per point and a None row after each line.'''
+    path = os.path.join(MAPPING_DIR, shapefile)
+    x, y, part_starts, part_record = read_shp(path)
+    lons, lats = to_wgs84(x, y, path + '.prj')
+    lons, lats = np.asarray(lons), np.asarray(lats)
+    encoding = 'utf-8'
+    if os.path.exists(path + '.cpg'):
+        with open(path + '.cpg') as f:
+            encoding = f.read().strip() or encoding
+    attributes = read_dbf(path, list(fields), encoding).rename(columns=fields)
+
+    part = np.searchsorted(part_starts, np.arange(len(x)), side='right') - 1
+    run = part
+    if clip_to:
+        lons, lats, part, run = clip(lons, lats, part, polygon_edges(clip_to))
+
+    # a separator row after the last point of each run, so every point moves down by the number of runs before it
+    last = np.r_[run[1:] != run[:-1], True] if len(run) else np.array([], dtype=bool)
+    rows = np.arange(len(run)) + np.r_[0, np.cumsum(last)[:-1]].astype(int)
+    separators = rows[last] + 1
+    n = len(run) + int(last.sum())
+
+    geo_df = pd.DataFrame({'lats': np.full(n, None, dtype=object), 'lons': np.full(n, None, dtype=object)})
+    geo_df.loc[rows, 'lats'] = lats
+    geo_df.loc[rows, 'lons'] = lons
+    record_of_row = np.empty(n, dtype=np.int64)
+    record_of_row[rows] = part_record[part]
+    record_of_row[separators] = part_record[part[last]]
+    for column in attributes.columns:
+        values = attributes[column].to_numpy(dtype=object)[record_of_row]
+        if column != 'Category':
+            values[separators] = None # separators only carry the category, so px keeps each category in one trace
+        geo_df[column] = values
+    if category is not None:
+        geo_df['Category'] = category
+    return geo_df
+
+
+def source_fingerprint(output):
+    '''sha1 of the source files and the settings of an output, it changes whenever the output has to be rebuilt.'''
+    source = SOURCES[output]
+    sha = hashlib.sha1(json.dumps(source, sort_keys=True).encode())
+    for shapefile in [source['shapefile'], source['clip']]:
+        for ext in SHAPEFILE_EXTENSIONS:
+            path = os.path.join(MAPPING_DIR, '%s%s' % (shapefile, ext))
+            if shapefile and os.path.exists(path):
+                with open(path, 'rb') as f:
+                    sha.update(path.encode() + hashlib.sha1(f.read()).digest())
+    return sha.hexdigest()
+
+
+def missing_files(output):
+    source = SOURCES[output]
+    required = [os.path.join(MAPPING_DIR, source['shapefile'] + ext) for ext in ['.shp', '.shx', '.dbf', '.prj']]
+    if source['clip']:
+        required += [os.path.join(MAPPING_DIR, source['clip'] + ext) for ext in ['.shp', '.shx', '.prj']]
+    return [path for path in required if not os.path.exists(path)]
+
+
+def convert(output, out_dir='.'):
+    '''Builds one output pickle, returns its path.'''
+    source = SOURCES[output]
+    geo_df = segments(source['shapefile'], source['fields'], source.get('category'), source['clip'])
+    path = os.path.join(out_dir, output)
+    geo_df.to_pickle(path, protocol=PICKLE_PROTOCOL)
+    return path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert the pipeline shape files into the segment pickles used by the webapp.')
+    parser.add_argument('outputs', nargs='*', help='outputs to build, any of %s (default: all)' % ', '.join(SOURCES))
+    parser.add_argument('--force', action='store_true', help='rebuild even if the shape files did not change')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes (default: number of cpus)')
+    parser.add_argument('--out-dir', default='.', help='directory for the pickles (default: the app directory)')
+    args = parser.parse_args(argv)
+    unknown = set(args.outputs) - set(SOURCES)
+    if unknown:
+        parser.error('unknown outputs: %s' % ', '.join(sorted(unknown)))
+
+    try:
+        with open(MANIFEST) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
+
+    todo, failed = {}, False
+    for output in args.outputs or list(SOURCES):
+        missing = missing_files(output)
+        if missing:
+            print('%s: skipped, missing %s' % (output, ', '.join(missing)))
+            failed = True
+            continue
+        fingerprint = source_fingerprint(output)
+        if not args.force and manifest.get(output) == fingerprint and os.path.exists(os.path.join(args.out_dir, output)):
+            print('%s: up to date' % output)
+            continue
+        todo[output] = fingerprint
+
+    # made here rather than in the workers, where the error would only come back through the futures
+    os.makedirs(args.out_dir, exist_ok=True)
+    os.makedirs(os.path.dirname(MANIFEST), exist_ok=True)
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = {output: pool.submit(convert, output, args.out_dir) for output in todo}
+        for output, future in futures.items():
+            try:
+                print('%s: written to %s' % (output, future.result()))
+                manifest[output] = todo[output]
+            except Exception as e:
+                print('%s: failed, %s' % (output, e))
+                failed = True
+
+    with open(MANIFEST, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
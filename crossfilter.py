@@ -0,0 +1,106 @@
+# Linked selections over the incidents, for the cross filter section of the webapp.
+# Every value of every dimension (year, state, cause, the fatality and injury flags) gets a bitmap of the incidents
+# with that value, built once per data version. A selection is the AND over the dimensions of the OR of the bitmaps
+# of the selected values, so answering it only intersects a few bitmaps instead of filtering and grouping the frame.
+# Like any cross filter each chart shows its dimension filtered by the selections on the other dimensions (its own
+# selected values are highlighted, the others stay visible to add). The answers are memoized on those selections, so
+# after a change in one dimension its own chart is not recomputed, only the charts of the other dimensions are.
+
+import numpy as np
+import pandas as pd
+
+from memo import Memo
+
+# dimension: the incident column it comes from
+DIMENSIONS = {'year': 'IYEAR', 'state': 'LOCATION_STATE_ABBREVIATION', 'cause': 'CAUSE',
+              'fatality': 'FATALITY_IND', 'injury': 'INJURY_IND'}
+MEASURES = {'fatal': 'FATAL', 'injure': 'INJURE'}
+
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.int64) # set bits of each byte
+
+
+def _value(v):
+    # plain python values for the widgets, None for a missing one
+    return None if pd.isna(v) else v.item() if hasattr(v, 'item') else v
+
+
+def selection_key(selections, exclude=None):
+    '''Hashable form of {dimension: selected values}, without the dimension exclude and the empty selections.'''
+    return tuple(sorted((dim, tuple(sorted(values, key=str))) for dim, values in selections.items()
+                        if values and dim != exclude))
+
+
+class CrossFilter:
+    '''Bitmap indexes over the rows of an incident frame, one per value of each of the DIMENSIONS.
+
+    Selections are {dimension: list of values}, a dimension with no values selected doesn't filter.
+    '''
+
+    def __init__(self, df, dimensions=DIMENSIONS, measures=MEASURES):
+        self.size = len(df)
+        self.values, self.codes, self.bitmaps = {}, {}, {}
+        for dim, column in dimensions.items():
+            codes, uniques = pd.factorize(df[column], sort=True, use_na_sentinel=False)
+            self.values[dim] = [_value(v) for v in uniques]
+            self.codes[dim] = codes
+            # one row of packed bits per value
+            self.bitmaps[dim] = np.packbits(codes[None, :] == np.arange(len(uniques))[:, None], axis=1)
+        self.measures = {name: df[column].to_numpy(dtype='int64') for name, column in measures.items()}
+        self._all = np.packbits(np.ones(self.size, dtype=bool))
+        self._answers = Memo() # bitmaps and answers, the app shares one cross filter between the sessions
+
+    def _memoized(self, key, compute):
+        return self._answers.get(key, compute)
+
+    def _selected(self, dim, values):
+        # OR of the bitmaps of the selected values of a dimension
+        def compute():
+            wanted = [self.values[dim].index(v) for v in values if v in self.values[dim]]
+            return np.bitwise_or.reduce(self.bitmaps[dim][wanted], axis=0) if wanted else np.zeros_like(self._all)
+        return self._memoized(('selected', dim, values), compute)
+
+    def _mask(self, key):
+        # AND of the selections in the key, the key of a mask is also the key of its answers
+        def compute():
+            mask = self._all
+            for dim, values in key:
+                mask = mask & self._selected(dim, values)
+            return mask
+        return self._memoized(('mask', key), compute) if key else self._all
+
+    def _rows(self, key):
+        return np.unpackbits(self._mask(key), count=self.size).view(bool)
+
+    def counts(self, dim, selections):
+        '''Number of incidents per value of dim, for the selections on the other dimensions.'''
+        key = selection_key(selections, exclude=dim)
+        counts = self._memoized(('counts', dim, key),
+                                lambda: _POPCOUNT[self.bitmaps[dim] & self._mask(key)].sum(axis=1))
+        return pd.Series(counts, index=self.values[dim], name='incidents')
+
+    def totals(self, dim, measure, selections):
+        '''Sum of a measure per value of dim, for the selections on the other dimensions.'''
+        key = selection_key(selections, exclude=dim)
+
+        def compute():
+            rows = self._rows(key)
+            return np.bincount(self.codes[dim][rows], weights=self.measures[measure][rows],
+                               minlength=len(self.values[dim])).astype('int64')
+        return pd.Series(self._memoized(('totals', dim, measure, key), compute), index=self.values[dim], name=measure)
+
+    def rows(self, selections):
+        '''Positions of the incidents matching all the selections.'''
+        key = selection_key(selections)
+        rows = self._memoized(('rows', key), lambda: np.flatnonzero(self._rows(key)))
+        rows.flags.writeable = False # shared with the other callers
+        return rows
+
+    def summary(self, selections):
+        '''Number of incidents, fatalities and injuries matching all the selections.'''
+        key = selection_key(selections)
+
+        def compute():
+            rows = self._rows(key)
+            return dict({'incidents': int(rows.sum())},
+                        **{name: int(values[rows].sum()) for name, values in self.measures.items()})
+        return dict(self._memoized(('summary', key), compute))
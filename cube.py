@@ -0,0 +1,122 @@
+# Pre-aggregated cube of the incident data: year x state x cause x cause details x dataset.
+# The cube is built once per data version with every rollup (cuboid) materialized, so the charts read their
+# aggregates from a few hundred pre-summed rows instead of grouping the full incident tables on every run.
+
+from itertools import combinations
+
+import pandas as pd
+
+from memo import Memo
+
+DIMENSIONS = ['dataset', 'year', 'state', 'cause', 'cause_details']
+MEASURES = ['incidents', 'fatal', 'injure', 'cost']
+
+# The state of an incident, the transmission data only has the state of the operator
+STATE_COLUMNS = {'transmission': 'OPERATOR_STATE_ABBREVIATION', 'distribution': 'LOCATION_STATE_ABBREVIATION'}
+# Estimated costs in dollars that add up to the cost of an incident
+COST_COLUMNS = ['EST_COST_OPER_PAID', 'EST_COST_PROP_DAMAGE', 'EST_COST_EMERGENCY', 'EST_COST_OTHER',
+                'EST_COST_UNINTENTIONAL_RELEASE', 'EST_COST_INTENTIONAL_RELEASE']
+
+
+def _total(frame):
+    # one row with the sum of each measure, keeping the integer measures integers
+    return pd.DataFrame({m: [frame[m].sum()] for m in MEASURES})
+
+
+def facts(dataset, df):
+    '''One row per incident with the cube dimensions and measures.'''
+    costs = [c for c in COST_COLUMNS if c in df.columns]
+    return pd.DataFrame({
+        'dataset': dataset,
+        'year': df['IYEAR'].astype(int).to_numpy(),
+        'state': df[STATE_COLUMNS[dataset]].astype(object).to_numpy(),
+        'cause': df['CAUSE'].astype(object).to_numpy(),
+        'cause_details': df['CAUSE_DETAILS'].astype(object).to_numpy(),
+        'incidents': 1,
+        'fatal': df['FATAL'].to_numpy(dtype='int64'), # stored as int16, the sums need more
+        'injure': df['INJURE'].to_numpy(dtype='int64'),
+        'cost': df[costs].sum(axis=1).to_numpy(),
+    })
+
+
+def _negated(facts):
+    facts[MEASURES] = -facts[MEASURES]
+    return facts
+
+
+def _cuboids(base):
+    # every rollup of the facts, keyed by the set of dimensions grouped on. Missing dimension values (e.g. no cause)
+    # are kept as their own group, like the rest of pandas they are NaN
+    cuboids = {}
+    for n in range(len(DIMENSIONS) + 1):
+        for dims in combinations(DIMENSIONS, n):
+            cuboids[frozenset(dims)] = base.groupby(list(dims), dropna=False)[MEASURES].sum() if dims else _total(base)
+    return cuboids
+
+
+class Cube:
+    '''All the rollups of the incident measures over the DIMENSIONS.
+
+    Built from {dataset name: incident frame}, query() then answers any slice/rollup from the materialized cuboids.
+    '''
+
+    def __init__(self, frames):
+        base = pd.concat([facts(name, df) for name, df in frames.items()], ignore_index=True)
+        self._set_cuboids(_cuboids(base))
+
+    @classmethod
+    def from_cuboids(cls, cuboids):
+        '''Cube from already materialized cuboids, e.g. the ones of another cube read back from shared_store.'''
+        cube = cls.__new__(cls)
+        cube._set_cuboids(cuboids)
+        return cube
+
+    def _set_cuboids(self, cuboids):
+        self.cuboids = cuboids
+        self._answers = Memo() # the app shares one cube between the sessions
+
+    def apply(self, dataset, removed, added):
+        '''New cube with the removed incidents of a dataset taken out and the added ones put in.
+
+        Only the facts of the changed incidents are aggregated and summed into the cuboids (see ingest.diff for
+        getting them from two releases), the cells no incident falls in anymore are dropped.
+        '''
+        delta = pd.concat([facts(dataset, added), _negated(facts(dataset, removed))], ignore_index=True)
+        cuboids = {}
+        for dims, change in _cuboids(delta).items():
+            cuboid = self.cuboids[dims]
+            if dims:
+                cuboid = pd.concat([cuboid, change]).groupby(level=list(cuboid.index.names), dropna=False).sum()
+                cuboid = cuboid[cuboid['incidents'] != 0]
+            else:
+                cuboid = _total(pd.concat([cuboid, change]))
+            cuboids[dims] = cuboid
+        return Cube.from_cuboids(cuboids)
+
+    def query(self, by=(), **where):
+        '''Measures grouped by the dimensions in by, for the rows matching where.
+
+        where maps a dimension to a value or a list of values, e.g. query(['year'], dataset='distribution', state=['CA', 'NY']).
+        The answers are memoized, a repeated query only costs a copy of the (small) answer.
+        '''
+        by = list(by)
+        unknown = set(by) - set(DIMENSIONS) | set(where) - set(DIMENSIONS)
+        if unknown:
+            raise KeyError('not a cube dimension: %s' % ', '.join(sorted(unknown)))
+        where = {dim: sorted(values, key=str) if isinstance(values, (list, tuple, set)) else [values]
+                 for dim, values in where.items()}
+        key = (tuple(by), tuple(sorted((dim, tuple(values)) for dim, values in where.items())))
+        return self._answers.get(key, lambda: self._query(by, where)).copy()
+
+    def _query(self, by, where):
+        cuboid = self.cuboids[frozenset(by) | frozenset(where)]
+        if where:
+            mask = True
+            for dim, values in where.items():
+                mask = mask & cuboid.index.get_level_values(dim).isin(values)
+            cuboid = cuboid[mask]
+            # the filter dimensions are summed out again, unless they are also grouped on
+            cuboid = cuboid.groupby(level=by, dropna=False).sum() if by else _total(cuboid)
+        elif len(by) > 1:
+            cuboid = cuboid.reorder_levels(by).sort_index()
+        return cuboid.reset_index() if by else cuboid.reset_index(drop=True)
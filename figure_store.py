@@ -0,0 +1,76 @@
+# Serialized figures for the webapp.
+# st.plotly_chart converts and JSON encodes a figure on every call, for every session, even though the figures are
+# the same for everyone until the data changes. Here each figure is serialized once per data version, kept with its
+# content hash, and plotly_chart() sends the stored spec as it is (the websocket compression of the server or of
+# serve.py compresses it on the way out).
+
+import hashlib
+import json
+import threading
+import weakref
+
+import plotly.io
+import plotly.utils
+import streamlit as st
+
+try: # streamlit internals, as of the streamlit==1.18.0 of requirements.txt
+    from streamlit.proto.PlotlyChart_pb2 import PlotlyChart as PlotlyChartProto
+except ImportError:
+    PlotlyChartProto = None
+
+# the config st.plotly_chart sends when none is given
+CHART_CONFIG = json.dumps({'showLink': False, 'linkText': False})
+
+
+class StoredFigure:
+    '''A figure serialized once: its plotly JSON spec and its content hash.'''
+
+    def __init__(self, spec):
+        self.spec = spec
+        data = spec.encode()
+        self.size = len(data)
+        self.digest = hashlib.sha256(data).hexdigest()
+
+
+def serialize(fig):
+    '''The JSON spec of a figure, the same as st.plotly_chart would send.'''
+    return json.dumps(fig.to_dict(), cls=plotly.utils.PlotlyJSONEncoder)
+
+
+class FigureStore:
+    '''Content addressed store of serialized figures.
+
+    A figure that comes out the same for a new data version (most of them when a release only adds a few incidents)
+    is stored once and shared by both versions. The store only holds weak references, a figure goes away with the
+    last cache entry using it.
+    '''
+
+    def __init__(self):
+        self._figures = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+
+    def put(self, fig):
+        stored = StoredFigure(serialize(fig))
+        with self._lock:
+            return self._figures.setdefault(stored.digest, stored)
+
+    def __len__(self):
+        return len(self._figures)
+
+
+def plotly_chart(stored, container=None, use_container_width=False, theme='streamlit'):
+    '''st.plotly_chart for a StoredFigure, the spec goes out without validating and encoding the figure again.'''
+    container = container or getattr(st, '_main', st)
+    # _enqueue and the PlotlyChart proto are private, checked with streamlit==1.18.0 (pinned in requirements.txt).
+    # After an upgrade that changed them the figure goes through st.plotly_chart, decoded from the spec (slower,
+    # but it still renders), until this is checked against the new version.
+    if PlotlyChartProto is None or not hasattr(container, '_enqueue'):
+        return container.plotly_chart(plotly.io.from_json(stored.spec, skip_invalid=True),
+                                      use_container_width=use_container_width, theme=theme)
+    proto = PlotlyChartProto()
+    proto.use_container_width = use_container_width
+    proto.figure.spec = stored.spec
+    proto.figure.config = CHART_CONFIG
+    proto.theme = theme or ''
+    # the same element st.plotly_chart adds, through the (private) enqueue of the container
+    return container._enqueue('plotly_chart', proto)
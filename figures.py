@@ -0,0 +1,243 @@
+# Plotly figures shown in the webapp. Each function takes the prepared dataframes and returns a figure,
+# so the app can cache the figures and they can also be built outside streamlit.
+
+import plotly.express as px
+import plotly.graph_objects as go
+
+
+def _usa_geos(fig):
+    fig.update_geos(
+        resolution=50,
+        showland=True, landcolor="#b1f699",
+        showlakes=True, lakecolor="LightBlue")
+    return fig
+
+
+def _coords(s):
+    # coordinates are stored as float32, which would go out with 16 digits, 5 decimals is about a metre
+    return s.astype('float64').round(5)
+
+
+def _segment_coords(geo_df):
+    # plotly looks up every category of a categorical colour column, the ones not in the frame (e.g. all of them for
+    # a view without lines) raise a KeyError
+    return geo_df.assign(lats=_coords(geo_df.lats), lons=_coords(geo_df.lons),
+                         Category=geo_df.Category.astype(object))
+
+
+def pipeline_map(geo_df, geo_df_trans, fit_view=False):
+    '''Inter/Intra state pipelines and the HGL transmission lines on one USA map.
+
+    With fit_view the map is zoomed to the lines passed in (see geo_lod.PipelineLOD.frame) instead of the whole USA.
+    '''
+    geo_df, geo_df_trans = _segment_coords(geo_df), _segment_coords(geo_df_trans)
+    # #Inter/Intra State Pipelines
+    fig = px.line_geo(geo_df, lat=geo_df.lats, lon=geo_df.lons, hover_name=geo_df.Operator_Name, locationmode="USA-states", scope="usa",
+                      hover_data={'lats': False,  # remove latitude form hover data
+                                  'lons': False,  # remove longitude form hover data
+                                  'Category': False,  # remove category from hover data
+                                  },
+                      color='Category')
+    fig.update_traces(line_color='#8723e3', line_width=0.25)  # updating the default lines used for HGL piepes
+
+    # HGL Transmission Lines
+    fig2 = px.line_geo(geo_df_trans, lat=geo_df_trans.lats, lon=geo_df_trans.lons, hover_name=geo_df_trans.Pipe_Name, locationmode="USA-states", scope="usa",
+                       hover_data={'lats': False,  # remove latitude form hover data
+                                   'lons': False,  # remove longitude form hover data
+                                   'Operator_Name': True,
+                                   'Category': False,  # remove category from hover data
+                                   },
+                       color='Category')
+    fig2.update_traces(line_color='#D70040', line_width=.75)  # updating the default lines used for HGL piepes
+
+    # Adding all the traces together in one map
+    fig.add_traces(fig2.data) # a single trace, or none when there are no transmission lines in the view
+    fig.update_layout(title='USA Gas Pipelines',
+                      hovermode="closest",
+                      margin={"r": 0, "t": 0, "l": 0, "b": 0},
+                      showlegend=False)
+    if fit_view:
+        fig.update_geos(fitbounds='locations')
+    return _usa_geos(fig)
+
+
+def transmission_year_state_bar(grouped_Year_State):
+    grouped_Year_State = grouped_Year_State.sort_values(by='No of Incidents', ascending=False)
+    fig = px.bar(data_frame=grouped_Year_State, y='Incident Year', x='No of Incidents',
+                 color='Incident State', orientation='h',
+                 color_discrete_sequence=px.colors.sequential.deep_r,
+                 title='Number of Gas Transmission Line Incidents in Past 10 Years by State')
+    fig.update_layout(showlegend=True)
+    return fig
+
+
+def cause_bar(Acc_Cause):
+    fig = px.bar(data_frame=Acc_Cause, y='Accident Cause', x='Number of Incidents', color='Details',
+                 color_discrete_sequence=px.colors.sequential.Bluyl_r, orientation='h',
+                 title='Causes of Gas Transmission Line Incidents in Past 10 Years', hover_data={'Accident Cause': False})
+    fig.update_layout(showlegend=False)
+    return fig
+
+
+def cause_pie(Acc_Cause):
+    return px.pie(Acc_Cause, values='Number of Incidents', names='Accident Cause',
+                  color_discrete_sequence=px.colors.sequential.Bluyl,
+                  title='Gas Distribution Indicent Cause Breakown')
+
+
+def incident_map(Gas_Dist_Acc, hover_text, fit_view=False):
+    '''Scatter map of the gas distribution incidents coloured by year.'''
+    years = Gas_Dist_Acc.IYEAR.astype(int)  # year is an ordered categorical in the ingest cache
+    fig = go.Figure(data=go.Scattergeo(
+        lat=_coords(Gas_Dist_Acc.LOCATION_LATITUDE), lon=_coords(Gas_Dist_Acc.LOCATION_LONGITUDE),
+        text=hover_text,
+        mode='markers',
+        marker=dict(
+            size=4,
+            opacity=0.8,
+            reversescale=True,
+            autocolorscale=False,
+            symbol='circle',
+            line=dict(
+                width=1,
+                color='rgba(219, 15, 15)'
+            ),
+            colorscale='Hot_r',
+            cmin=2010,
+            color=years,
+            cmax=years.max(),
+            colorbar_title="Incident Year")))
+
+    fig.update_layout(
+        title='Gas distribution line incidents in the last 10 years',
+        geo_scope='usa',
+        hovermode="closest",
+        margin={"r": 0, "t": 0, "l": 10, "b": 0},
+        showlegend=True
+    )
+    if fit_view:
+        fig.update_geos(fitbounds='locations')
+    return _usa_geos(fig)
+
+
+def incident_density_map(bins, fit_view=False):
+    '''The incidents binned in a grid (see incidents.binned), a marker per cell sized and coloured by the count.'''
+    fig = go.Figure(data=go.Scattergeo(
+        lat=bins.lat, lon=bins.lon,
+        text=bins.text,
+        mode='markers',
+        marker=dict(
+            size=4 + 3*bins.incidents**0.5,
+            sizemode='diameter',
+            opacity=0.8,
+            line=dict(width=0),
+            colorscale='Hot_r',
+            color=bins.incidents,
+            colorbar_title="Incidents")))
+    fig.update_layout(
+        title='Gas distribution line incidents in the last 10 years',
+        geo_scope='usa',
+        hovermode="closest",
+        margin={"r": 0, "t": 0, "l": 10, "b": 0})
+    if fit_view:
+        fig.update_geos(fitbounds='locations')
+    return _usa_geos(fig)
+
+
+def nearby_incidents_map(near, geo_df_trans, fit_view=False):
+    '''The incidents found near the transmission lines on top of those lines.'''
+    fig = go.Figure()
+    fig.add_trace(go.Scattergeo(lat=_coords(geo_df_trans.lats), lon=_coords(geo_df_trans.lons), mode='lines',
+                                line=dict(color='#D70040', width=.75), hoverinfo='skip', name='Transmission lines'))
+    fig.add_trace(go.Scattergeo(
+        lat=_coords(near.LOCATION_LATITUDE), lon=_coords(near.LOCATION_LONGITUDE), mode='markers',
+        text=near['Nearest Pipeline'] + ', ' + near['Distance (km)'].astype(str) + ' km',
+        marker=dict(size=5, color='rgba(219, 15, 15)'), name='Incidents'))
+    fig.update_layout(geo_scope='usa', hovermode="closest", margin={"r": 0, "t": 0, "l": 0, "b": 0}, showlegend=False)
+    if fit_view:
+        fig.update_geos(fitbounds='locations')
+    return _usa_geos(fig)
+
+
+def selection_bar(labels, counts, selected, title, horizontal=False):
+    '''Incidents per value of a cross filter dimension (see crossfilter.py), the selected values highlighted.'''
+    colors = ['#D70040' if s or not any(selected) else 'lightgrey' for s in selected]
+    if horizontal:
+        bar = go.Bar(y=labels, x=counts, orientation='h', hovertemplate='%{y}: %{x} incidents<extra></extra>')
+    else:
+        bar = go.Bar(x=labels, y=counts, hovertemplate='%{x}: %{y} incidents<extra></extra>')
+    fig = go.Figure(data=bar.update(marker_color=colors))
+    fig.update_layout(title=title, margin={"r": 0, "t": 40, "l": 0, "b": 0})
+    if horizontal:
+        fig.update_yaxes(autorange='reversed')
+    return fig
+
+
+def _sorted_by_year(grouped_Year_State):
+    # Make sure you sort the time horizon column in ascending order
+    return grouped_Year_State.sort_values(by='No of Incidents', ascending=False).sort_values('Incident Year')
+
+
+def distribution_year_state_bar(grouped_Year_State):
+    fig = px.bar(data_frame=_sorted_by_year(grouped_Year_State), y='No of Incidents', x='Incident State',
+                 color='Incident Year', orientation='v',
+                 color_continuous_scale=px.colors.sequential.OrRd_r,
+                 title='Number of Gas Distribution Incidents in Past 10 Years by State')
+    fig.update_layout(showlegend=True)
+    return fig
+
+
+def year_state_choropleth(grouped_Year_State):
+    '''Animated choropleth of the number of incidents per state, one frame per year.'''
+    fig = px.choropleth(_sorted_by_year(grouped_Year_State),
+                        locations='Incident State',
+                        locationmode="USA-states",
+                        scope="usa",
+                        color='No of Incidents',
+                        color_continuous_scale="agsunset_r",
+                        animation_frame='Incident Year'  # make sure 'Incident Year' is sorted in ascending order
+                        )
+    fig.update_layout(margin={"r": 0, "t": 0, "l": 0, "b": 0})
+    return fig
+
+
+def casualties_bar(Casualties_by_State):
+    fig = px.bar(data_frame=Casualties_by_State, y='Casualties', x='State', color='Cause',
+                 color_discrete_sequence=px.colors.sequential.Jet, orientation='v',
+                 hover_data={'Cause Details'},
+                 title='Casualties of Gas Distribution Line Incidents in Past 10 Years')
+    fig.update_layout(showlegend=True)
+    return fig
+
+
+def casualties_choropleth(casualties_per_state):
+    fig = px.choropleth(casualties_per_state,
+                        locations='State',
+                        locationmode="USA-states",
+                        scope="usa",
+                        color='Casualties',
+                        color_continuous_scale="speed",
+                        )
+    fig.update_layout(margin={"r": 0, "t": 0, "l": 0, "b": 0})
+    return fig
+
+
+def rolling_trend(series, window_days):
+    '''Incidents and casualties in the rolling window ending at each incident (see trends.TrendStream.series).'''
+    fig = go.Figure()
+    for column, color in [('incidents', '#0047AB'), ('casualties', '#D70040')]:
+        fig.add_trace(go.Scatter(x=series['time'], y=series[column], name=column.capitalize(), line_shape='hv',
+                                 line_color=color))
+    fig.update_layout(title='Incidents and Casualties in the Last %d Days' % window_days, hovermode='x unified')
+    return fig
+
+
+def alerts_timeline(alerts):
+    '''The windows that spiked (see trends.TrendStream.alerts_frame), when and in which state, operator or cause.'''
+    fig = px.scatter(alerts.round({'expected_incidents': 1, 'expected_casualties': 1, 'z': 1}),
+                     x='time', y='dimension', color='dimension', size='incidents', hover_name='value',
+                     hover_data={'dimension': False, 'incidents': True, 'expected_incidents': True,
+                                 'casualties': True, 'expected_casualties': True, 'z': True},
+                     title='Spikes over Time')
+    fig.update_layout(showlegend=False, yaxis_title=None, xaxis_title=None)
+    return fig
@@ -0,0 +1,148 @@
+# Level of detail for the pipeline network map.
+# The segment frames (geo_df/geo_df_trans) hold every vertex of every pipeline with None rows separating the lines,
+# which makes the map a multi megabyte payload. Here the lines are simplified with Douglas-Peucker at a few
+# tolerances and the vertices are indexed by grid tiles, so the app only sends the lines, and the level of detail,
+# that fit the selected view of the map.
+
+import math
+
+import numpy as np
+import pandas as pd
+
+# Douglas-Peucker tolerances in degrees, coarsest first. 0 keeps every vertex.
+LOD_TOLERANCES = [0.05, 0.01, 0.002, 0.0]
+TILE_SIZE = 2 # degrees
+MAP_WIDTH_PX = 700 # rough width of the map, the tolerance is kept under half a pixel of the view
+
+# The views of the map that can be selected, as (lon_min, lon_max, lat_min, lat_max)
+FULL_VIEW = 'Continental USA'
+VIEWS = {
+    FULL_VIEW: (-125, -66, 24, 50),
+    'West': (-125, -102, 31, 49),
+    'Midwest': (-104, -80, 36, 49),
+    'Northeast': (-81, -66, 37, 48),
+    'Southeast': (-92, -75, 24, 37),
+    'Texas and Gulf of Mexico': (-107, -88, 25, 37),
+}
+
+
+def split_lines(lats):
+    '''Start and end (exclusive) rows of each line, the lines are separated by rows with no coordinates.'''
+    gap = np.isnan(lats)
+    rows = np.arange(len(gap))
+    starts = rows[~gap & np.r_[True, gap[:-1]]]
+    ends = rows[~gap & np.r_[gap[1:], True]] + 1
+    return starts, ends
+
+
+def douglas_peucker(x, y, tolerance):
+    '''Mask of the vertices of a line kept by the Douglas-Peucker simplification.'''
+    keep = np.zeros(len(x), dtype=bool)
+    if tolerance <= 0 or len(x) < 3:
+        keep[:] = True
+        return keep
+    keep[0] = keep[-1] = True
+    stack = [(0, len(x) - 1)]
+    while stack:
+        i, j = stack.pop()
+        if j - i < 2:
+            continue
+        dx, dy = x[j] - x[i], y[j] - y[i]
+        px, py = x[i+1:j] - x[i], y[i+1:j] - y[i]
+        norm = math.hypot(dx, dy)
+        # distance of the in between vertices from the chord (or from its start for closed lines)
+        dist = np.abs(dx*py - dy*px)/norm if norm else np.hypot(px, py)
+        k = int(np.argmax(dist))
+        if dist[k] > tolerance:
+            k += i + 1
+            keep[k] = True
+            stack.append((i, k))
+            stack.append((k, j))
+    return keep
+
+
+def tolerance_for(bbox):
+    '''The coarsest level of detail that is still under half a pixel for the given view.'''
+    lon_min, lon_max, lat_min, lat_max = bbox
+    span = max((lon_max - lon_min)*math.cos(math.radians((lat_min + lat_max)/2)), lat_max - lat_min)
+    target = span/MAP_WIDTH_PX/2
+    return next((t for t in LOD_TOLERANCES if t <= target), 0.0)
+
+
+class PipelineLOD:
+    '''Simplified versions of a segment frame and a tile index over its vertices.
+
+    Built once per data version (the app caches it), for_view()/frame() then return the segment frame for a view.
+    '''
+
+    def __init__(self, geo_df):
+        self.geo_df = geo_df.reset_index(drop=True)
+        self.lats = pd.to_numeric(self.geo_df['lats']).to_numpy(dtype=float)
+        self.lons = pd.to_numeric(self.geo_df['lons']).to_numpy(dtype=float)
+        starts, ends = split_lines(self.lats)
+
+        self.line_of_row = np.full(len(self.lats), -1)
+        for line, (s, e) in enumerate(zip(starts, ends)):
+            self.line_of_row[s:e] = line
+
+        # vertices kept at each level of detail, distances are in degrees with the longitudes scaled to the latitude
+        self.levels = {}
+        for tolerance in LOD_TOLERANCES:
+            keep = np.zeros(len(self.lats), dtype=bool)
+            for s, e in zip(starts, ends):
+                lat = self.lats[s:e]
+                x = self.lons[s:e]*math.cos(math.radians(lat.mean()))
+                keep[s:e] = douglas_peucker(x, lat, tolerance)
+            self.levels[tolerance] = keep
+
+        # tile -> lines with a vertex in that tile
+        on_line = self.line_of_row >= 0
+        tiles = pd.DataFrame({'tx': np.floor(self.lons[on_line]/TILE_SIZE).astype(int),
+                              'ty': np.floor(self.lats[on_line]/TILE_SIZE).astype(int),
+                              'line': self.line_of_row[on_line]}).drop_duplicates()
+        self.tiles = {k: g['line'].to_numpy() for k, g in tiles.groupby(['tx', 'ty'])}
+
+    def lines_in(self, bbox):
+        '''Lines with a vertex in any of the tiles covering the bounding box.'''
+        lon_min, lon_max, lat_min, lat_max = bbox
+        found = [self.tiles[(tx, ty)]
+                 for tx in range(math.floor(lon_min/TILE_SIZE), math.floor(lon_max/TILE_SIZE) + 1)
+                 for ty in range(math.floor(lat_min/TILE_SIZE), math.floor(lat_max/TILE_SIZE) + 1)
+                 if (tx, ty) in self.tiles]
+        return np.unique(np.concatenate(found)) if found else np.array([], dtype=int)
+
+    def frame(self, bbox=None, tolerance=None):
+        '''Segment frame (same columns as the input) with only the lines in the view, at its level of detail.
+
+        The lines are clipped one tile outside the view so they run off the edges of the map.
+        '''
+        if tolerance is None:
+            tolerance = tolerance_for(bbox) if bbox else LOD_TOLERANCES[0]
+        keep = self.levels[tolerance].copy()
+        breaks = self.line_of_row < 0
+        if bbox:
+            lon_min, lon_max, lat_min, lat_max = bbox
+            inside = ((lon_min - TILE_SIZE <= self.lons) & (self.lons <= lon_max + TILE_SIZE)
+                      & (lat_min - TILE_SIZE <= self.lats) & (self.lats <= lat_max + TILE_SIZE))
+            keep &= np.isin(self.line_of_row, self.lines_in(bbox)) & inside
+            breaks |= ~inside
+        # vertices dropped by the simplification are skipped over, the ones clipped away start a new line
+        run = np.cumsum(breaks)
+        rows = np.flatnonzero(keep)
+        if not len(rows):
+            return self.geo_df.iloc[:0]
+        # a separator row after the last vertex of each run, it's a copy of that vertex with no coordinates
+        last = np.r_[run[rows][1:] != run[rows][:-1], True]
+        order = np.argsort(np.r_[np.arange(len(rows)), np.flatnonzero(last) + 0.5], kind='stable')
+        out = self.geo_df.iloc[np.r_[rows, rows[last]][order]].reset_index(drop=True)
+        separators = np.r_[np.zeros(len(rows), dtype=bool), np.ones(last.sum(), dtype=bool)][order]
+        out.loc[separators, ['lats', 'lons']] = None
+        return out
+
+    def for_view(self, view):
+        '''Segment frame for one of the VIEWS.'''
+        bbox = VIEWS[view]
+        if view == FULL_VIEW:
+            # the whole map, nothing to clip (this keeps Alaska and Hawaii in the insets)
+            return self.frame(tolerance=tolerance_for(bbox))
+        return self.frame(bbox)
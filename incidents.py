@@ -0,0 +1,121 @@
+# Filtering and aggregation of the PHMSA incident data used by the webapp.
+# These are plain pandas functions with no streamlit calls so they can be cached by the app and reused elsewhere.
+
+import numpy as np
+import pandas as pd
+
+import spatial
+
+# Bounds of the continental USA, I have discovered some outliers that fall outside these
+LON_MIN, LON_MAX = -140, -50
+LAT_MAX = 50
+
+# The incident map shows the single incidents up to this many in the view, above it they are binned in a grid with
+# about BINS_ACROSS cells across the view
+MAX_MAP_POINTS = 5000
+BINS_ACROSS = 80
+
+
+def filter_continental(df):
+    '''Drops the incidents that fall outside the continental USA.'''
+    df = df[(LON_MIN < df['LOCATION_LONGITUDE']) & (df['LOCATION_LONGITUDE'] < LON_MAX)]
+    return df[df['LOCATION_LATITUDE'] < LAT_MAX]
+
+
+# The aggregates below read from the pre-aggregated cube (see cube.py), dataset is 'transmission' or 'distribution'.
+# Groups with a missing state/cause are dropped, like a groupby on the incident table would.
+
+def year_state_counts(cube, dataset):
+    '''Number of incidents per year and state.'''
+    grouped = cube.query(['year', 'state'], dataset=dataset).dropna(subset=['state'])
+    grouped = grouped[['year', 'state', 'incidents']]
+    grouped.columns = ['Incident Year', 'Incident State', 'No of Incidents']
+    return grouped
+
+
+def cause_counts(cube, dataset):
+    '''Number of incidents per cause and cause detail.'''
+    cause = cube.query(['cause', 'cause_details'], dataset=dataset).dropna(subset=['cause', 'cause_details'])
+    cause = cause[['cause', 'cause_details', 'incidents']]
+    cause.columns = ['Accident Cause', 'Details', 'Number of Incidents']
+    cause['Accident Cause'] = cause['Accident Cause'].str.lower().str.title()
+    cause['Details'] = cause['Details'].str.lower().str.capitalize()
+    return cause
+
+
+def casualty_totals(cube, dataset):
+    '''Table of the total number of deaths and injuries.'''
+    totals = cube.query(dataset=dataset)
+    data = {'Death': totals['fatal'].iloc[0], 'Injury': totals['injure'].iloc[0]}
+    return pd.DataFrame(data, index=['Number of Casualties'])
+
+
+def casualties_by_state(cube, dataset):
+    '''Fatalities and injuries per state, cause and cause details, for the groups with casualties.'''
+    by_state = cube.query(['state', 'cause', 'cause_details'], dataset=dataset).dropna(subset=['state', 'cause', 'cause_details'])
+    by_state = by_state[by_state['fatal'] + by_state['injure'] > 0]
+    by_state = by_state[['state', 'cause', 'cause_details', 'fatal', 'injure']].reset_index(drop=True)
+    by_state.columns = ['State', 'Cause', 'Cause Details', 'Number_Fatalities', 'Number_Injuried']
+    by_state['Cause'] = by_state['Cause'].str.lower().str.capitalize()
+    by_state['Cause Details'] = by_state['Cause Details'].str.lower().str.capitalize()
+    by_state['Casualties'] = by_state['Number_Fatalities'] + by_state['Number_Injuried']
+    return by_state
+
+
+def casualties_per_state(by_state):
+    '''Rolls casualties_by_state up to the states only, for the heatmap.'''
+    return by_state.groupby('State')[['Number_Fatalities', 'Number_Injuried', 'Casualties']].sum().reset_index()
+
+
+def _per_value(column, fn):
+    # applies a string function once per distinct value instead of once per row
+    codes, values = pd.factorize(column)
+    if not len(values): # all missing, text[codes] would index an empty array
+        return pd.Series(np.nan, index=column.index, dtype=object)
+    text = fn(pd.Series(values, dtype=object).astype(str)).to_numpy()
+    return pd.Series(np.where(codes >= 0, text[codes], np.nan), index=column.index)
+
+
+def hover_text(df):
+    '''City, state, cause and year of each incident for the map hover labels.'''
+    return (_per_value(df['LOCATION_CITY_NAME'], lambda s: s.str.title()) + ', '
+            + df['LOCATION_STATE_ABBREVIATION'].astype(str) + ', '
+            + 'Cause: ' + _per_value(df['CAUSE'], lambda s: s.str.lower().str.capitalize()) + ', '
+            + df['IYEAR'].astype(str))
+
+
+def bin_size(bbox):
+    '''Grid cell size in degrees for binning the incidents of a view.'''
+    lon_min, lon_max, lat_min, lat_max = bbox
+    return max(lon_max - lon_min, lat_max - lat_min)/BINS_ACROSS
+
+
+def binned(df, cell_size):
+    '''Incidents binned in a lon/lat grid: per occupied cell the mean location, the number of incidents, the first
+    and last year and the casualties, with the hover text of the cell.'''
+    cells = spatial.grid_keys(df['LOCATION_LONGITUDE'], df['LOCATION_LATITUDE'], cell_size)
+    grouped = pd.DataFrame({'cell': cells,
+                            'lon': df['LOCATION_LONGITUDE'].to_numpy(dtype=float),
+                            'lat': df['LOCATION_LATITUDE'].to_numpy(dtype=float),
+                            'year': df['IYEAR'].astype(int).to_numpy(),
+                            'casualties': df['FATAL'].to_numpy(dtype='int64') + df['INJURE'].to_numpy(dtype='int64')}
+                           ).groupby('cell')
+    bins = grouped.agg(lon=('lon', 'mean'), lat=('lat', 'mean'), incidents=('year', 'size'),
+                       first_year=('year', 'min'), last_year=('year', 'max'), casualties=('casualties', 'sum'))
+    bins['text'] = ('Incidents: ' + bins['incidents'].astype(str) + ', ' + bins['first_year'].astype(str) + '-'
+                    + bins['last_year'].astype(str) + ', Casualties: ' + bins['casualties'].astype(str))
+    return bins.reset_index(drop=True)
+
+
+def near_pipelines(df, points, segments, geo_df, bbox, max_km):
+    '''Incidents in the bounding box within max_km of a pipeline, with the nearest pipeline and its distance.
+
+    points is a spatial.PointIndex over the incident locations of df and segments a spatial.SegmentIndex over geo_df.
+    '''
+    near = df.iloc[points.bbox(*bbox)]
+    segment, km = segments.nearest(near['LOCATION_LONGITUDE'], near['LOCATION_LATITUDE'], max_km)
+    found = segment >= 0
+    near = near[found].copy()
+    near['Nearest Pipeline'] = geo_df['Pipe_Name'].iloc[segment[found]].to_numpy()
+    near['Distance (km)'] = km[found].round(1)
+    return near.sort_values('Distance (km)')
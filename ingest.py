@@ -0,0 +1,234 @@
+# Ingest layer for the PHMSA incident csv files.
+# Parsing the raw csv (hundreds of columns) dominates the page load, so each csv is converted once into a
+# parquet file holding only the required columns, in the compact types of schema.py. The cache is invalidated
+# when either the source file or the list of required columns changes.
+# PHMSA republishes the whole csv with the new incidents and the supplemental reports of old ones, so when only
+# the source changed the cache is updated incrementally: the reports are diffed on their REPORT_NUMBER and
+# SUPPLEMENTAL_NUMBER and only the new or revised rows are parsed (python ingest.py runs this as a refresh job).
+# Only this cache and the incident cube (cube.Cube.apply) are updated incrementally, the other structures built on
+# the incidents (the spatial point index, the cross filter bitmaps, the trend stream) are rebuilt in full for every
+# data version.
+
+import argparse
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+import pandas as pd
+
+from schema import apply_schema, column_kind, parse_dtypes
+
+try:
+    import pyarrow  # noqa: F401  parquet engine
+    HAVE_PARQUET = True
+except ImportError:  # fall back to reading the csv directly
+    HAVE_PARQUET = False
+
+CACHE_DIR = os.path.join('data', 'cache')
+
+# Every report is identified by its number, a revised report (a supplemental) gets a higher SUPPLEMENTAL_NUMBER.
+# These are always kept in the cache so the next release can be diffed against it.
+KEY_COLUMNS = ['REPORT_NUMBER', 'SUPPLEMENTAL_NUMBER']
+
+
+def read_required_columns(columns_path):
+    '''Reads the list of required columns from the text file, one column name per line.'''
+    with open(columns_path) as f:
+        return [l.strip() for l in f if l.strip()]
+
+
+def stored_columns(columns):
+    '''The required columns plus the key columns, which is what the cache holds.'''
+    return columns + [k for k in KEY_COLUMNS if k not in columns]
+
+
+def file_fingerprint(path, chunk_size=1 << 20):
+    '''sha1 of the file contents, used to detect a new data release.'''
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def file_stamp(path):
+    '''Cheap fingerprint from the file size and modification time, used as a cache key on every rerun.'''
+    st = os.stat(path)
+    return '%d-%d' % (st.st_size, st.st_mtime_ns)
+
+
+def columns_fingerprint(columns):
+    return hashlib.sha1('\n'.join(columns).encode()).hexdigest()
+
+
+def parse_csv(csv_path, columns, rows=None, dtypes=None):
+    '''Parses only the required columns of the raw csv, and only the given data rows (0 based) if rows is set.'''
+    dtypes = dtypes or parse_dtypes(columns)
+    skiprows = None if rows is None else (lambda i, rows=set(rows): i > 0 and i - 1 not in rows)
+    df = pd.read_csv(csv_path, usecols=columns, dtype=dtypes, skiprows=skiprows, low_memory=False)
+    return apply_schema(df[columns])
+
+
+def unique_keys(df):
+    '''Whether every report of a frame has its own KEY_COLUMNS, diff() and update() need them to.'''
+    return not df.duplicated(subset=KEY_COLUMNS).any()
+
+
+def diff(old, new):
+    '''Compares two releases on the KEY_COLUMNS.
+
+    Returns the positions of the rows of old that are gone from new (deleted, or replaced by a supplemental) and the
+    positions of the rows of new that are not in old (inserted, or the supplemental replacing a row). new only needs
+    the key columns.
+    '''
+    old_keys = old[KEY_COLUMNS].reset_index(drop=True).rename_axis('old').reset_index()
+    new_keys = new[KEY_COLUMNS].reset_index(drop=True).rename_axis('new').reset_index()
+    both = old_keys.merge(new_keys, on=KEY_COLUMNS, how='outer', indicator=True)
+    removed = both.loc[both['_merge'] == 'left_only', 'old'].astype('int64').to_numpy()
+    added = both.loc[both['_merge'] == 'right_only', 'new'].astype('int64').to_numpy()
+    return removed, added
+
+
+def summarize(old, new, removed, added):
+    '''Number of inserted, updated and deleted reports between two releases, from the output of diff().'''
+    gone = set(old['REPORT_NUMBER'].iloc[removed])
+    came = set(new['REPORT_NUMBER'].iloc[added])
+    return {'inserted': len(came - gone), 'updated': len(came & gone), 'deleted': len(gone - came)}
+
+
+def update(stored, csv_path, columns):
+    '''Brings the stored frame (with the KEY_COLUMNS) up to date with a new release of the csv.
+
+    Only the keys of the whole release and the rows that changed are parsed. The result has the row order of the
+    csv, so it is the same frame a full parse would give. Returns it with the summary of the changes.
+    The few fresh rows are parsed with the schema, and the columns outside of it with the dtypes of the stored frame
+    as the parser would guess them differently. A ValueError means the release doesn't fit them, or has duplicate
+    keys, and the cache has to be rebuilt.
+    '''
+    keys = pd.read_csv(csv_path, usecols=KEY_COLUMNS, dtype=parse_dtypes(KEY_COLUMNS))
+    if not unique_keys(keys) or not unique_keys(stored):
+        raise ValueError('%s has reports with the same REPORT_NUMBER and SUPPLEMENTAL_NUMBER' % csv_path)
+    removed, added = diff(stored, keys)
+    kept = stored.drop(index=stored.index[removed])
+    dtypes = parse_dtypes(columns)
+    dtypes.update({c: str if isinstance(t, pd.CategoricalDtype) else t
+                   for c, t in stored.dtypes.items() if column_kind(c) is None})
+    fresh = parse_csv(csv_path, columns, rows=added, dtypes=dtypes)
+    # put the kept and fresh rows in the order of the csv
+    position = pd.Series(range(len(keys)), index=pd.MultiIndex.from_frame(keys))
+    df = pd.concat([kept, fresh], ignore_index=True) # categoricals that differ become objects, apply_schema redoes them
+    order = position.loc[pd.MultiIndex.from_frame(df[KEY_COLUMNS])].to_numpy().argsort(kind='stable')
+    df = apply_schema(df.iloc[order].reset_index(drop=True))
+    return df, summarize(stored, keys, removed, added)
+
+
+def _cache_paths(csv_path, cache_dir):
+    stem = os.path.splitext(os.path.basename(csv_path))[0]
+    return os.path.join(cache_dir, stem + '.parquet'), os.path.join(cache_dir, stem + '.json')
+
+
+def _read_meta(meta_path):
+    try:
+        with open(meta_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_atomic(path, write):
+    # write into a temporary file of its own first and move it in place, so a reader (or another writer) never sees
+    # a half written file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path) + '.', suffix='.tmp')
+    os.close(fd)
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+# One refresh of a cache file at a time in this process, the app refreshes from the sessions and the warm-up thread
+_refresh_locks = {}
+_refresh_locks_lock = threading.Lock()
+
+
+def _refresh_lock(path):
+    with _refresh_locks_lock:
+        return _refresh_locks.setdefault(os.path.abspath(path), threading.Lock())
+
+
+def refresh(csv_path, columns_path, cache_dir=CACHE_DIR):
+    '''Brings the parquet cache of an incident csv up to date, incrementally when only the csv changed.
+
+    Returns the cached frame (required and key columns) and the changes, None when the cache was up to date and
+    'rebuilt' when it was parsed from scratch.
+    '''
+    parquet_path, meta_path = _cache_paths(csv_path, cache_dir)
+    with _refresh_lock(parquet_path):
+        return _refresh(csv_path, columns_path, parquet_path, meta_path)
+
+
+def _refresh(csv_path, columns_path, parquet_path, meta_path):
+    columns = stored_columns(read_required_columns(columns_path))
+    meta = {'source': file_fingerprint(csv_path), 'columns': columns_fingerprint(columns)}
+    old_meta = _read_meta(meta_path) if os.path.exists(parquet_path) else None
+    if old_meta and old_meta['columns'] == meta['columns']:
+        # parquet keeps the string categoricals but not the ordered integer ones, so reapply the schema
+        stored = apply_schema(pd.read_parquet(parquet_path, columns=columns))
+        if old_meta['source'] == meta['source']:
+            return stored, None
+        try:
+            df, changes = update(stored, csv_path, columns)
+        except ValueError: # a column changed its type in the new release, or its keys aren't unique
+            df, changes = parse_csv(csv_path, columns), 'rebuilt'
+    else:
+        df, changes = parse_csv(csv_path, columns), 'rebuilt'
+
+    os.makedirs(os.path.dirname(parquet_path), exist_ok=True)
+    # the parquet goes in before the meta: a reader with the old meta and the new parquet only diffs it again
+    _write_atomic(parquet_path, lambda path: df.to_parquet(path, index=False))
+    meta['changes'] = changes
+
+    def write_meta(path):
+        with open(path, 'w') as f:
+            json.dump(meta, f)
+    _write_atomic(meta_path, write_meta)
+    return df, changes
+
+
+def load_incidents(csv_path, columns_path, cache_dir=CACHE_DIR, keys=False):
+    '''Returns the required columns of an incident csv (and the KEY_COLUMNS with keys), going through the parquet
+    cache when possible.'''
+    columns = read_required_columns(columns_path)
+    wanted = stored_columns(columns) if keys else columns
+    if not HAVE_PARQUET:
+        return parse_csv(csv_path, wanted)
+    return refresh(csv_path, columns_path, cache_dir)[0][wanted]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Update the parquet caches with a new release of the incident csv files.')
+    parser.add_argument('datasets', nargs='*', metavar='CSV:COLUMNS',
+                        help='incident csv and its required columns file, by default the gas transmission and distribution data')
+    parser.add_argument('--cache-dir', default=CACHE_DIR)
+    args = parser.parse_args()
+    if not HAVE_PARQUET:
+        parser.error('pyarrow is needed for the parquet cache')
+    datasets = [d.split(':', 1) for d in args.datasets] or [
+        ('data/incident_gas_transmission_gathering_jan2010_present.csv', 'data/Gas_Trans_required_columns.txt'),
+        ('data/incident_gas_distribution_jan2010_present.csv', 'data/Gas_Dist_required_columns.txt')]
+    for csv_path, columns_path in datasets:
+        df, changes = refresh(csv_path, columns_path, args.cache_dir)
+        if changes is None:
+            print('%s: up to date' % csv_path)
+        elif changes == 'rebuilt':
+            print('%s: rebuilt, %d reports' % (csv_path, len(df)))
+        else:
+            print('%s: %d inserted, %d updated, %d deleted' % (csv_path, changes['inserted'], changes['updated'], changes['deleted']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+# Bounded memo of query answers, for the structures the app shares between its sessions (cube.Cube,
+# crossfilter.CrossFilter). functools.lru_cache doesn't fit them: it would be one cache for all the instances of a
+# class (keeping them alive), and their answers are computed outside of any lock so a slow one doesn't hold up the
+# other sessions.
+
+import threading
+
+MAX_ANSWERS = 1024
+
+
+class Memo:
+    '''Answers by key, at most size of them, the oldest are dropped first.'''
+
+    def __init__(self, size=MAX_ANSWERS):
+        self.size = size
+        self._answers = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, compute):
+        '''The answer of key, compute() makes it when it isn't memoized (two sessions may both make it).'''
+        with self._lock:
+            answer = self._answers.get(key)
+        if answer is None:
+            answer = compute()
+            with self._lock:
+                if len(self._answers) >= self.size:
+                    del self._answers[next(iter(self._answers))]
+                self._answers[key] = answer
+        return answer
+
+    def clear(self):
+        with self._lock:
+            self._answers.clear()
+
+    def __len__(self):
+        return len(self._answers)
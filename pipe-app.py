@@ -1,12 +1,266 @@
 #This is my webapp visualising and exploring the available USA Gas Pipeline incident data
 
+import os
+import threading
+
+import numpy as np
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx
 import pandas as pd
-import plotly
-import plotly.graph_objects as go
-import plotly.offline as pyo
-from plotly.offline import init_notebook_mode
-import plotly.express as px
+
+import crossfilter
+import cube
+import figure_store
+import figures
+import geo_lod
+import incidents
+import spatial
+import trends
+from ingest import diff, file_stamp, load_incidents, unique_keys
+from schema import compact_segments
+
+# The loading, filtering, aggregation and figure construction below are cached process wide, so they are shared
+# by all the sessions and a widget interaction or a new visitor doesn't rebuild everything. The caches are keyed on
+# the file stamps of the inputs, so a new data file is picked up automatically, and they are bounded so the
+# entries for old data versions are evicted.
+CACHE_TTL = 24*60*60 # seconds
+CACHE_ENTRIES = 4
+
+GEO_DF = 'geo_df.pkl' # Gas distribution lines file, its the largest
+GEO_DF_TRANS = 'geo_df_trans.pkl' #Gas transmission lines file
+NEAR_KM = 10 # default distance of the incidents near the transmission lines
+TRANS_INCIDENTS = ('data/incident_gas_transmission_gathering_jan2010_present.csv', 'data/Gas_Trans_required_columns.txt')
+DIST_INCIDENTS = ('data/incident_gas_distribution_jan2010_present.csv', 'data/Gas_Dist_required_columns.txt')
+
+# serve.py runs the app in several worker processes, which read the prepared data from the store it builds
+SHARED_STORE = os.environ.get('PIPE_SHARED_STORE')
+if SHARED_STORE:
+    import shared_store
+
+
+def stamp(*paths):
+    if SHARED_STORE:
+        # the data version is the version of the store, whichever file the data comes from
+        return (shared_store.current_version(SHARED_STORE),)*len(paths)
+    return tuple(file_stamp(p) for p in paths)
+
+
+if SHARED_STORE:
+    @st.cache_resource(max_entries=shared_store.KEEP_VERSIONS, show_spinner=False)
+    def shared_data(version):
+        return shared_store.SharedStore(version, SHARED_STORE)
+
+    # memory mapped from the store and shared by the sessions as they are, st.cache_data would copy them for each
+    @st.cache_resource(ttl=CACHE_TTL, max_entries=CACHE_ENTRIES, show_spinner=False)
+    def load_segments(path, path_stamp):
+        return shared_data(path_stamp).segments(path)
+
+    @st.cache_resource(ttl=CACHE_TTL, max_entries=2*CACHE_ENTRIES, show_spinner=False)
+    def load_filtered_incidents(dataset, dataset_stamp, keys=False):
+        return shared_data(dataset_stamp[0]).incidents(dataset[0], keys)
+else:
+    @st.cache_data(ttl=CACHE_TTL, max_entries=CACHE_ENTRIES, show_spinner=False)
+    def load_segments(path, path_stamp):
+        return compact_segments(pd.read_pickle(path))
+
+    @st.cache_data(ttl=CACHE_TTL, max_entries=2*CACHE_ENTRIES, show_spinner=False)
+    def load_filtered_incidents(dataset, dataset_stamp, keys=False):
+        # I have discovered some outliers that fall outside the continental USA, so I will exclude those
+        return incidents.filter_continental(load_incidents(*dataset, keys=keys))
+
+
+# The last cube built and the incident frames it was built from. When a new PHMSA release comes in, only the
+# reports that changed since are applied to it instead of aggregating everything again.
+@st.cache_resource(show_spinner=False)
+def latest_cube():
+    return {'lock': threading.Lock(), 'frames': None, 'cube': None}
+
+
+# The year x state x cause x dataset aggregates of both incident datasets, all the charts read from this cube
+@st.cache_resource(ttl=CACHE_TTL, max_entries=CACHE_ENTRIES, show_spinner=False)
+def incident_cube(cube_stamp):
+    if SHARED_STORE: # aggregated once when the store was built
+        return shared_data(cube_stamp[0][0]).cube()
+    frames = {'transmission': load_filtered_incidents(TRANS_INCIDENTS, cube_stamp[0], keys=True),
+              'distribution': load_filtered_incidents(DIST_INCIDENTS, cube_stamp[1], keys=True)}
+    latest = latest_cube()
+    with latest['lock']:
+        # the changes can only be found by their keys when they are unique, in the old frames too
+        if latest['cube'] is None or not all(map(unique_keys, [*frames.values(), *latest['frames'].values()])):
+            latest['cube'] = cube.Cube(frames)
+        else:
+            for name, df in frames.items():
+                old = latest['frames'][name]
+                removed, added = diff(old, df)
+                if len(removed) or len(added):
+                    latest['cube'] = latest['cube'].apply(name, old.iloc[removed], df.iloc[added])
+        latest['frames'] = frames
+        return latest['cube']
+
+
+# The simplified pipelines and their tile index are built once per data version
+@st.cache_resource(ttl=CACHE_TTL, max_entries=CACHE_ENTRIES, show_spinner=False)
+def pipeline_lod(path, path_stamp):
+    return geo_lod.PipelineLOD(load_segments(path, path_stamp))
+
+
+# The spatial indexes over the incident locations and the pipeline segments are built once per data version
+@st.cache_resource(ttl=CACHE_TTL, max_entries=CACHE_ENTRIES, show_spinner=False)
+def incident_index(dataset, dataset_stamp):
+    df = load_filtered_incidents(dataset, dataset_stamp)
+    return spatial.PointIndex(df['LOCATION_LONGITUDE'], df['LOCATION_LATITUDE'])
+
+
+@st.cache_resource(ttl=CACHE_TTL, max_entries=CACHE_ENTRIES, show_spinner=False)
+def segment_index(path, path_stamp):
+    return spatial.SegmentIndex(load_segments(path, path_stamp))
+
+
+@st.cache_data(ttl=CACHE_TTL, max_entries=64, show_spinner=False)
+def incidents_near_transmission(dataset_stamp, segments_stamp, view, max_km):
+    return incidents.near_pipelines(load_filtered_incidents(DIST_INCIDENTS, dataset_stamp),
+                                    incident_index(DIST_INCIDENTS, dataset_stamp),
+                                    segment_index(GEO_DF_TRANS, segments_stamp),
+                                    load_segments(GEO_DF_TRANS, segments_stamp),
+                                    geo_lod.VIEWS[view], max_km)
+
+
+# The figures are serialized once per data version into the figure store (see figure_store.py) and the cached
+# entries are shared by all the sessions, so a page load only sends the stored JSON.
+@st.cache_resource(show_spinner=False)
+def stored_figures():
+    return figure_store.FigureStore()
+
+
+@st.cache_resource(ttl=CACHE_TTL, max_entries=CACHE_ENTRIES*len(geo_lod.VIEWS), show_spinner=False)
+def pipeline_map_figure(segments_stamp, view):
+    # only the lines in the view are sent, at the level of detail that fits its zoom
+    return stored_figures().put(figures.pipeline_map(pipeline_lod(GEO_DF, segments_stamp[0]).for_view(view),
+                                                     pipeline_lod(GEO_DF_TRANS, segments_stamp[1]).for_view(view),
+                                                     fit_view=view != geo_lod.FULL_VIEW))
+
+
+@st.cache_resource(ttl=CACHE_TTL, max_entries=CACHE_ENTRIES, show_spinner=False)
+def transmission_figures(cube_stamp):
+    grouped_Year_State = incidents.year_state_counts(incident_cube(cube_stamp), 'transmission')
+    Acc_Cause = incidents.cause_counts(incident_cube(cube_stamp), 'transmission')
+    store = stored_figures()
+    return {'year_state': store.put(figures.transmission_year_state_bar(grouped_Year_State)),
+            'cause_bar': store.put(figures.cause_bar(Acc_Cause)),
+            'cause_pie': store.put(figures.cause_pie(Acc_Cause))}
+
+
+@st.cache_resource(ttl=CACHE_TTL, max_entries=CACHE_ENTRIES, show_spinner=False)
+def distribution_figures(cube_stamp):
+    grouped_Year_State = incidents.year_state_counts(incident_cube(cube_stamp), 'distribution')
+    store = stored_figures()
+    return {'year_state': store.put(figures.distribution_year_state_bar(grouped_Year_State)),
+            'choropleth': store.put(figures.year_state_choropleth(grouped_Year_State))}
+
+
+@st.cache_resource(ttl=CACHE_TTL, max_entries=CACHE_ENTRIES, show_spinner=False)
+def casualty_figures(cube_stamp):
+    Casualties_by_State = incidents.casualties_by_state(incident_cube(cube_stamp), 'distribution')
+    store = stored_figures()
+    return {'casualties_bar': store.put(figures.casualties_bar(Casualties_by_State)),
+            'casualties_choropleth': store.put(figures.casualties_choropleth(incidents.casualties_per_state(Casualties_by_State)))}
+
+
+# The incidents in the view are shown one by one when there are few enough, otherwise they are binned in a grid,
+# the hover text is only made for what is shown
+@st.cache_resource(ttl=CACHE_TTL, max_entries=CACHE_ENTRIES*len(geo_lod.VIEWS), show_spinner=False)
+def incident_map_figure(dataset_stamp, view):
+    Gas_Dist_Acc = load_filtered_incidents(DIST_INCIDENTS, dataset_stamp)
+    fit_view = view != geo_lod.FULL_VIEW
+    if fit_view:
+        Gas_Dist_Acc = Gas_Dist_Acc.iloc[np.sort(incident_index(DIST_INCIDENTS, dataset_stamp).bbox(*geo_lod.VIEWS[view]))]
+    if len(Gas_Dist_Acc) > incidents.MAX_MAP_POINTS:
+        bins = incidents.binned(Gas_Dist_Acc, incidents.bin_size(geo_lod.VIEWS[view]))
+        return stored_figures().put(figures.incident_density_map(bins, fit_view))
+    return stored_figures().put(figures.incident_map(Gas_Dist_Acc, incidents.hover_text(Gas_Dist_Acc), fit_view))
+
+
+@st.cache_resource(ttl=CACHE_TTL, max_entries=64, show_spinner=False)
+def nearby_map_figure(dataset_stamp, segments_stamp, view, max_km):
+    return stored_figures().put(figures.nearby_incidents_map(
+        incidents_near_transmission(dataset_stamp, segments_stamp, view, max_km),
+        pipeline_lod(GEO_DF_TRANS, segments_stamp).for_view(view), fit_view=view != geo_lod.FULL_VIEW))
+
+
+# The cross filter of the distribution incidents, its bitmap indexes are built once per data version and the answers
+# are memoized in it (see crossfilter.py). The figures are keyed on the selections they depend on, so a selection
+# change only rebuilds the charts it affects.
+@st.cache_resource(ttl=CACHE_TTL, max_entries=CACHE_ENTRIES, show_spinner=False)
+def incident_crossfilter(dataset_stamp):
+    return crossfilter.CrossFilter(load_filtered_incidents(DIST_INCIDENTS, dataset_stamp))
+
+
+CROSSFILTER_TITLES = {'year': 'Years', 'state': 'States', 'cause': 'Causes', 'fatality': 'Fatalities', 'injury': 'Injuries'}
+
+
+def crossfilter_label(dim, value):
+    if value is None:
+        return 'Unknown'
+    if dim in ('fatality', 'injury'):
+        return 'Yes' if value else 'No'
+    return value.lower().capitalize() if dim == 'cause' else str(value)
+
+
+@st.cache_resource(ttl=CACHE_TTL, max_entries=256, show_spinner=False)
+def crossfilter_bar_figure(dataset_stamp, dim, key):
+    # key is the selection_key of all the selections, the own selection of dim is highlighted
+    selected = dict(key).get(dim, ())
+    counts = incident_crossfilter(dataset_stamp).counts(dim, dict(key))
+    return stored_figures().put(figures.selection_bar([crossfilter_label(dim, v) for v in counts.index], counts.to_numpy(),
+                                                      [v in selected for v in counts.index],
+                                                      'Incidents by %s' % dim, horizontal=dim == 'cause'))
+
+
+@st.cache_resource(ttl=CACHE_TTL, max_entries=256, show_spinner=False)
+def crossfilter_state_figure(dataset_stamp, key):
+    # key is the selection_key without the states, the map shows all of them
+    cf = incident_crossfilter(dataset_stamp)
+    casualties = cf.totals('state', 'fatal', dict(key)) + cf.totals('state', 'injure', dict(key))
+    return stored_figures().put(figures.casualties_choropleth(
+        pd.DataFrame({'State': casualties.index, 'Casualties': casualties.to_numpy()}).dropna(subset=['State'])))
+
+
+@st.cache_resource(ttl=CACHE_TTL, max_entries=256, show_spinner=False)
+def crossfilter_map_figure(dataset_stamp, key):
+    selections = dict(key)
+    Gas_Dist_Acc = load_filtered_incidents(DIST_INCIDENTS, dataset_stamp)
+    Gas_Dist_Acc = Gas_Dist_Acc.iloc[incident_crossfilter(dataset_stamp).rows(selections)]
+    if not len(Gas_Dist_Acc):
+        return None
+    fit_view = bool(selections.get('state'))
+    if len(Gas_Dist_Acc) > incidents.MAX_MAP_POINTS:
+        bins = incidents.binned(Gas_Dist_Acc, incidents.bin_size(geo_lod.VIEWS[geo_lod.FULL_VIEW]))
+        return stored_figures().put(figures.incident_density_map(bins, fit_view))
+    return stored_figures().put(figures.incident_map(Gas_Dist_Acc, incidents.hover_text(Gas_Dist_Acc), fit_view))
+
+
+# The rolling windows of both incident datasets, streamed once per data version and window length (see trends.py)
+TREND_WINDOWS = {'Month': 30, 'Quarter': 91, 'Half year': 182, 'Year': 365} # days
+
+
+@st.cache_resource(ttl=CACHE_TTL, max_entries=CACHE_ENTRIES*len(TREND_WINDOWS), show_spinner=False)
+def trend_stream(cube_stamp, window_days):
+    frames = {'transmission': load_filtered_incidents(TRANS_INCIDENTS, cube_stamp[0]),
+              'distribution': load_filtered_incidents(DIST_INCIDENTS, cube_stamp[1])}
+    return trends.replay(frames, window=pd.Timedelta(days=window_days))
+
+
+@st.cache_resource(ttl=CACHE_TTL, max_entries=CACHE_ENTRIES*len(TREND_WINDOWS), show_spinner=False)
+def trend_figures(cube_stamp, window_days):
+    stream = trend_stream(cube_stamp, window_days)
+    store = stored_figures()
+    return {'series': store.put(figures.rolling_trend(stream.series(), window_days)),
+            'alerts': store.put(figures.alerts_timeline(stream.alerts_frame()))}
+
+
+trans_stamp = stamp(*TRANS_INCIDENTS)
+dist_stamp = stamp(*DIST_INCIDENTS)
+cube_stamp = (trans_stamp, dist_stamp)
 
 st.write("""
 
@@ -28,82 +282,29 @@ In this project we explore the incident data provided by the **Pipeline and Haza
 
 """)
 
-st.write("""
+
+def pipeline_map_section():
+    st.write("""
 # Pipeline Geographical Locations 
 The figures below show the geographical locations of the gas pipelines. The data associated with these can viwed by hovering over the individual shape. 
 The pipeline representations are in two parts, the __Transmission lines__, and the __Distribution lines__. The map is interactive and can be manipulated with 
 the menu options on the top right. The information about each pipeline can be viewed by hovering over it.
+Selecting a region below zooms into it with more of the pipeline detail.
 """)
-# Loading the converted shape files. The shape files have to be converted from their geometric multiline representations to lat/lon 
-# representations of the two ends of each of the segments. The algorithm to do this is in the previous versions of the code in the github repository. 
-# You can simply uncomment each cell and have the .pkl variable constructed again. It just takes a little bit fo time, hence the 
-# loading of the variable to save time.  
-geo_df_trans = pd.read_pickle('geo_df_trans.pkl') #Gas transmission lines file
-geo_df = pd.read_pickle('geo_df.pkl') # Gas distribution lines file, its the largest
-#geo_df_mx = pd.read_pickle('geo_df_mx.pkl') #Gas pipelines in the Gulf of Mexico
-
-#Plotting the dataframe we made with lats, lons and names etc form the HGL, Inter/Intra and Gulf of Mexico shape files, 
-# we manipulate the hoverdata to display what we like.
-
-
-# # #--------------------------------------
-# #Inter/Intra State Pipelines
-fig = px.line_geo(geo_df,lat = geo_df.lats, lon = geo_df.lons, hover_name = geo_df.Operator_Name, locationmode="USA-states", scope="usa",
-                 hover_data={'lats':False, #remove latitude form hover data
-                             'lons':False, #remove longitude form hover data
-                             'Category':False, #remove category from hover data
-                            },
-                               color = 'Category' )
-fig.update_traces(line_color='#8723e3', line_width=0.25) #updating the default lines used for HGL piepes
-# #--------------------------------------
-
-#HGL Transmission Lines
-#plotting the shape file onto the USA map using plotly
-fig2 = px.line_geo(geo_df_trans,lat = geo_df_trans.lats, lon = geo_df_trans.lons, hover_name = geo_df_trans.Pipe_Name, locationmode="USA-states", scope="usa",
-                 hover_data={'lats':False, #remove latitude form hover data
-                             'lons':False, #remove longitude form hover data
-                             'Operator_Name': True, 
-                             'Category':False, #remove category from hover data
-                            },
-                               color = 'Category')
-fig2.update_traces(line_color='#D70040', line_width=.75) #updating the default lines used for HGL piepes
-# #
-
-# # # GULF OF MEXICO
-# fig3 = px.line_geo(geo_df_mx,lat = geo_df_mx.lats, lon = geo_df_mx.lons, hover_name = geo_df_mx.Operator_Name, locationmode="USA-states", scope="usa",
-#                  hover_data={'lats':False, #remove latitude form hover data
-#                              'lons':False, #remove longitude form hover data
-#                              'Category':False, #remove category from hover data
-#                               },
-#                               color = 'Category' )
-
-# fig3.update_traces(line_color='#8723e3', line_width=0.25) #updating the default lines used for HGL piepes
-
-
-
-# # #--------------------------------------
-# #Adding all the traces together in one map
-fig.add_trace(fig2.data[0]) 
-#fig.add_trace(fig3.data[0]) 
-# # #--------------------------------------
-
-# #fig.update_layout()
-fig.update_layout(title = 'USA Gas Pipelines',
-                  hovermode="closest",
-                  margin={"r":0,"t":0,"l":0,"b":0},
-                  showlegend = False)
-
-fig.update_geos(
-    resolution=50,
-    showland=True, landcolor="#b1f699",
-    showlakes=True, lakecolor="LightBlue")
-
-st.plotly_chart(fig)
+    # Loading the converted shape files. The shape files have to be converted from their geometric multiline representations to lat/lon 
+    # representations of the two ends of each of the segments, run convert_shapefiles.py to build the .pkl files again from data/mapping.
+    # The loading of the pickled variables and building the map are cached since it takes a little bit of time.
+    map_view = st.selectbox('Map view', list(geo_lod.VIEWS))
+    figure_store.plotly_chart(pipeline_map_figure(stamp(GEO_DF, GEO_DF_TRANS), map_view))
 
-st.write("""
+    st.write("""
 
 We can see that the highest concentration of the pipelines is in the state of Texas, followed by the Gulf of Mexico region and Oklahoma.
+""")
+
 
+def transmission_section():
+    st.write("""
 # Loading and Filtering the Gas Transmission Lines Incident Data
 
 Now that we have some knowledge about the location of the various types of gas pipelines,
@@ -112,76 +313,29 @@ We start with the gas transmission pipelines.
 
 """)
 
-#changed encoding by saving as csv file again, tab delimited
-Gas_Dist_Accidents = pd.read_csv('data/incident_gas_transmission_gathering_jan2010_present.csv',low_memory=False) 
-
-
-# Reading in the required columns form the text file. I have kept it as a text file so it is easy to modify for future uses. 
-req_clmns = []
-#importing the list of required columns form the text file
-with open('data/Gas_Trans_required_columns.txt') as f: 
-    lines = f.readlines()
-f.close()
-
-for l in lines:
-    req_clmns.append(l.strip()) #getting rid of the "\n" escape character
+    # Reading in only the required columns listed in the text file. I have kept it as a text file so it is easy to modify for future uses.
+    # The csv is converted once into a typed parquet cache (see ingest.py) so we don't parse every PHMSA column on each run.
+    Gas_Dist_Acc = load_filtered_incidents(TRANS_INCIDENTS, trans_stamp)
+    trans_figs = transmission_figures(cube_stamp)
 
-Gas_Dist_Acc = Gas_Dist_Accidents[req_clmns]
-# I have discovered some outliers that fall outside the continental USA, so I will explude those: 
-Gas_Dist_Acc = Gas_Dist_Acc[(-140<Gas_Dist_Acc['LOCATION_LONGITUDE']) & (Gas_Dist_Acc['LOCATION_LONGITUDE']<-50)]
-Gas_Dist_Acc = Gas_Dist_Acc[Gas_Dist_Acc['LOCATION_LATITUDE']<50]
+    st.write('''Here is a representation of the available data:  ''')
 
+    #Dispalying the dataframe on the webapp
+    st.dataframe(Gas_Dist_Acc)
 
+    st.write('''Over the last 10 years, 1512 incidents have ben recorded in the gas transmission pipelines.''')
 
-#Grouping the dataframe by year and then state counts, and sorting it.
-grouped_Year_State = Gas_Dist_Acc.groupby(['IYEAR','OPERATOR_STATE_ABBREVIATION']).count().sort_values(by = 'REPORT_NUMBER',  ascending=False).reset_index()
+    figure_store.plotly_chart(trans_figs['year_state'])
 
-# The column report number (1 on 1 relationship) can be our incident count so:
-grouped_Year_State.rename(columns = {'IYEAR':'Incident Year','OPERATOR_STATE_ABBREVIATION':'Incident State', 'REPORT_NUMBER':'No of Incidents'}, inplace=True)
 
-st.write('''Here is a representation of the available data:  ''')
-
-#Dispalying the dataframe on the webapp
-st.dataframe(Gas_Dist_Acc)
-
-st.write('''Over the last 10 years, 1512 incidents have ben recorded in the gas transmission pipelines.''')
-
-# Plotting the data using plotly:
-fig = px.bar(data_frame=grouped_Year_State, y = 'Incident Year', x = 'No of Incidents',
-            color = 'Incident State', orientation='h', 
-            color_discrete_sequence= px.colors.sequential.deep_r,
-            title='Number of Gas Transmission Line Incidents in Past 10 Years by State') #remove latitude form pipe)
-
-fig.update_layout(showlegend=True)
-st.plotly_chart(fig)
-
-
-st.write("""
+    st.write("""
 ## Exploring the Injuries, Fatalities and Cuases of Gas Transmission Line Incidents
 ### Fatalities and Injuries
 """)
 
-# Calculating the number of fatalities
-fatality = Gas_Dist_Acc['FATAL'].value_counts().reset_index()
-fatality.rename(columns={'index':'Fatalities'}, inplace = True)
-fatality['deaths'] = fatality['Fatalities']*fatality['FATAL']
-# print('The fatality count is:')
-# print(fatality['deaths'].sum())
-Deaths = fatality['deaths'].sum()
-
-# Calculating the number of injuries
-injury = Gas_Dist_Acc['INJURE'].value_counts().reset_index()
-injury.rename(columns={'index':'Injuries'}, inplace = True)
-injury['injuries'] = injury['Injuries']*injury['INJURE']
-# print('The injury count is:')
-# print(injury['injuries'].sum())
-Injuries = injury['injuries'].sum()
-
-data = {'Death':fatality['deaths'].sum(),'Injury':injury['injuries'].sum()}
-Casualties=pd.DataFrame(data,index=['Number of Casualties'])
-st.table(Casualties)
+    st.table(incidents.casualty_totals(incident_cube(cube_stamp), 'transmission'))
 
-st.write("""
+    st.write("""
 We can see that over the last 10 years, a total of 31 deaths and 117 injuries have occured. Given that the transmission lines are generally not in populated areas and are not very widespread, this low count is expected. We will compare this with the far more extensive and widespread distribution network.
 
 ### Causes of the Gas Transmission Line Incidents
@@ -189,152 +343,64 @@ PHMSA has categorised the gas transmission line incident cause into 8 different
 below presents the causes of the gas transmission pipeline incidents in the last 10 years. The cause details and number of incidents for each can be viewed by hovering over each segment.
 """)
 
-Acc_Cause = Gas_Dist_Acc.groupby(['CAUSE','CAUSE_DETAILS']).count().reset_index()
-Acc_Cause.rename(columns = {'REPORT_NUMBER':'Number of Incidents','CAUSE':'Accident Cause', 'CAUSE_DETAILS':'Details'}, inplace=True) #each incident has a report number so its count is incident count
-
-Acc_Cause['Accident Cause'] = Acc_Cause['Accident Cause'].str.lower().str.title()
-Acc_Cause['Details'] = Acc_Cause['Details'].str.lower().str.capitalize()
-# #trying with plotly express
-fig = px.bar(data_frame=Acc_Cause, y = 'Accident Cause', x = 'Number of Incidents', color = 'Details',
-            color_discrete_sequence= px.colors.sequential.Bluyl_r, orientation='h', 
-            title='Causes of Gas Transmission Line Incidents in Past 10 Years',hover_data={'Accident Cause':False}) #remove latitude form pipe)
-fig.update_layout(showlegend=False)
-st.plotly_chart(fig)
+    figure_store.plotly_chart(trans_figs['cause_bar'])
 
-st.write('''We can see that the main cause for the incidents is equiment failure followed by corrosion failure. To get a 
+    st.write('''We can see that the main cause for the incidents is equiment failure followed by corrosion failure. To get a 
 better understanding of the share of each incident cause we can use a pie chart:
  ''')
 
-fig = px.pie(Acc_Cause, values='Number of Incidents', names='Accident Cause',
-             color_discrete_sequence= px.colors.sequential.Bluyl,
-             title = 'Gas Distribution Indicent Cause Breakown')
-st.plotly_chart(fig)
+    figure_store.plotly_chart(trans_figs['cause_pie'])
+
 
-st.write(''' # Incidents in the Gas Distribution Network 
+def distribution_section():
+    st.write(''' # Incidents in the Gas Distribution Network 
 We now explore the incidents in the gas distribution network which is far more extensive than the transmission pipeline and affects
 geographical locations with high population density. We will first explore the geographical locations
 of the gas distribution pipelines in the last 10 years.
 ''')
-# Working on Gas Distribution Accidents now:
-#changed encoding by saving as csv file again, tab delimited
-Gas_Dist_Accidents = pd.read_csv('data/incident_gas_distribution_jan2010_present.csv',low_memory=False) 
-req_clmns =  []
-with open('data/Gas_Dist_required_columns.txt') as f: #importing the list of required columns form the text file
-    lines = f.readlines()
-f.close()
-for l in lines:
-    req_clmns.append(l.strip()) #getting rid of the "\n" escape character
-Gas_Dist_Acc = Gas_Dist_Accidents[req_clmns]
-#There is an outlier in the longitude column (large negative number), so we find it 
-# and drop that whole row so we can do the plotting 
-drop_row_index = Gas_Dist_Acc['LOCATION_LONGITUDE'].idxmin() #getting the row index for the minimum oulier 
-Gas_Dist_Acc.drop(Gas_Dist_Acc.index[drop_row_index])
-
-# I have discovered some outliers that fall outside the continental USA, so I will explude those: 
-Gas_Dist_Acc = Gas_Dist_Acc[(-140<Gas_Dist_Acc['LOCATION_LONGITUDE']) & (Gas_Dist_Acc['LOCATION_LONGITUDE']<-50)]
-Gas_Dist_Acc = Gas_Dist_Acc[Gas_Dist_Acc['LOCATION_LATITUDE']<50]
-
-st.write('''Over the last 10 years, 1314 incidents have been recorded in the gas distribution pipelines.''')
-
-
-#Formatting  the hovertext
-Gas_Dist_Acc['hover_text'] = Gas_Dist_Acc["LOCATION_CITY_NAME"].str.title()+", "+ Gas_Dist_Acc["LOCATION_STATE_ABBREVIATION"]+ ", "+"Cause: "+Gas_Dist_Acc['CAUSE'].str.lower().str.capitalize()+", " + Gas_Dist_Acc["IYEAR"].astype(str)
-
-fig = go.Figure(data = go.Scattergeo(
-                    lat=Gas_Dist_Acc.LOCATION_LATITUDE, lon=Gas_Dist_Acc.LOCATION_LONGITUDE,
-                    text=Gas_Dist_Acc['hover_text'], 
-                    mode = 'markers',
-                    marker = dict(
-                    size = 4,
-                    opacity = 0.8,
-                    reversescale = True,
-                    autocolorscale = False,
-                    symbol = 'circle', 
-                    line = dict(
-                        width=1,
-                        color='rgba(219, 15, 15)'
-                    ),
-                    colorscale = 'Hot_r',
-                    cmin = 2010,
-                    color = Gas_Dist_Acc.IYEAR,
-                    cmax = Gas_Dist_Acc.IYEAR.max(),
-                    colorbar_title="Incident Year")))
-
-fig.update_layout(
-        title = 'Gas distribution line incidents in the last 10 years',
-        geo_scope='usa',
-        hovermode="closest",
-        margin={"r":0,"t":0,"l":10,"b":0},
-        showlegend = True
-    )
-fig.update_geos(
-    resolution=50,
-    showland=True, landcolor="#b1f699",
-    showlakes=True, lakecolor="LightBlue")
-
-st.plotly_chart(fig)
-
-st.write('''As can be seen from the figure above the majority of the gas distribution line incidents happen in the major 
-population centres in the USA. It is beneficial to have a more detailed view of the number of incidents in each state over the
-span of 10 years.''')
-grouped_Year_State = Gas_Dist_Acc.groupby(['IYEAR','LOCATION_STATE_ABBREVIATION']).count().sort_values(by = 'NAME',  ascending=False).reset_index()
+    # Working on Gas Distribution Accidents now, the outliers in the longitude column (large negative numbers) are
+    # dropped by the same continental USA filter as above so we can do the plotting
+    dist_figs = distribution_figures(cube_stamp)
+
+    st.write('''Over the last 10 years, 1314 incidents have been recorded in the gas distribution pipelines.''')
 
-#creating a data frame as the output of the groupby. The product of the groupby is a series, 
-# so you do a to_frame to get the df and then reset the index to get a proper index
-# The column NAME (1 on 1 relationship) can be our incident count so:
 
-grouped_Year_State.rename(columns = {'IYEAR':'Incident Year','LOCATION_STATE_ABBREVIATION':'Incident State', 'NAME':'No of Incidents'}, inplace=True)
-#Sorting based on year
-grouped_Year_State=grouped_Year_State.sort_values("Incident Year") # Make sure you sort the time horizon column in ascending order
-#plotting using plotly:
-fig = px.bar(data_frame=grouped_Year_State, y ='No of Incidents' , x = 'Incident State',
-            color = 'Incident Year', orientation='v', 
-            color_continuous_scale=px.colors.sequential.OrRd_r,
-            title='Number of Gas Distribution Incidents in Past 10 Years by State') #remove latitude form pipe)
+    incident_view = st.selectbox('Map view', list(geo_lod.VIEWS), key='incident_view')
+    figure_store.plotly_chart(incident_map_figure(dist_stamp, incident_view))
 
-fig.update_layout(showlegend=True)
-st.plotly_chart(fig)
+    st.write('''
+### Incidents Near the Transmission Lines
+Select a region and a distance to find the gas distribution incidents that happened close to a gas transmission line,
+together with the nearest pipeline.
+''')
+    near_view = st.selectbox('Region', list(geo_lod.VIEWS), key='near_view')
+    near_km = st.slider('Distance to a transmission line (km)', min_value=1, max_value=100, value=NEAR_KM)
+    near = incidents_near_transmission(dist_stamp, stamp(GEO_DF_TRANS)[0], near_view, near_km)
+    st.write('%d incidents within %d km of a transmission line.' % (len(near), near_km))
+    figure_store.plotly_chart(nearby_map_figure(dist_stamp, stamp(GEO_DF_TRANS)[0], near_view, near_km))
+    st.dataframe(near[['Nearest Pipeline', 'Distance (km)', 'IYEAR', 'LOCATION_CITY_NAME', 'LOCATION_STATE_ABBREVIATION', 'CAUSE']])
+
+    st.write('''As can be seen from the first map above the majority of the gas distribution line incidents happen in the major 
+population centres in the USA. It is beneficial to have a more detailed view of the number of incidents in each state over the
+span of 10 years.''')
+    figure_store.plotly_chart(dist_figs['year_state'])
 
-st.write('''The figure above is not very telling and difficult to interpret even with the hover text.
+    st.write('''The figure above is not very telling and difficult to interpret even with the hover text.
  So we do a choropleth map for every year. So we will try another method of presenting the data. We can use an animated choropleth map that displays the density of incidents per year for each state[[2]](https://towardsdatascience.com/simplest-way-of-creating-a-choropleth-map-by-u-s-states-in-python-f359ada7735e) 
 ''')
-fig = px.choropleth(grouped_Year_State,
-                    locations='Incident State', 
-                    locationmode="USA-states", 
-                    scope="usa",
-                    color='No of Incidents',
-                    color_continuous_scale="agsunset_r", 
-                    animation_frame='Incident Year' #make sure 'Incident Year' is string type and sorted in ascending order
-                    )
-fig.update_layout(margin={"r":0,"t":0,"l":0,"b":0})
-st.plotly_chart(fig)
-
-st.write('''
+    figure_store.plotly_chart(dist_figs['choropleth'])
+
+
+def casualties_section():
+    st.write('''
 ## Explorting the Injuries, Fatalities and Cuases of the Gas Transmission Network Incidents
 ### Fatalities and Injuries
  ''')
 
-# Calculating the number of fatalities
-fatality = Gas_Dist_Acc['FATAL'].value_counts().reset_index()
-fatality.rename(columns={'index':'Fatalities'}, inplace = True)
-fatality['deaths'] = fatality['Fatalities']*fatality['FATAL']
-# print('The fatality count is:')
-# print(fatality['deaths'].sum())
-Deaths = fatality['deaths'].sum()
-
-# Calculating the number of injuries
-injury = Gas_Dist_Acc['INJURE'].value_counts().reset_index()
-injury.rename(columns={'index':'Injuries'}, inplace = True)
-injury['injuries'] = injury['Injuries']*injury['INJURE']
-# print('The injury count is:')
-# print(injury['injuries'].sum())
-Injuries = injury['injuries'].sum()
-
-data = {'Death':fatality['deaths'].sum(),'Injury':injury['injuries'].sum()}
-Casualties=pd.DataFrame(data,index=['Number of Casualties'])
-st.table(Casualties)
-
-st.write('''
+    st.table(incidents.casualty_totals(incident_cube(cube_stamp), 'distribution'))
+    casualty_figs = casualty_figures(cube_stamp)
+
+    st.write('''
 As can be seen from the table above, the injury/fatality rate is larger than
 the Gas Transmission lines injury/fatality, so this warrants a closer look.
 It is beneficial to combine the fatalities and the injuries into a new column "Casualties".
@@ -345,43 +411,103 @@ the casualties are higher when there is an incident.
 In terms of causes, it can be seen that natural force damage due to earth movement followed
 by unknown causes contribute to the highest casualties in the last 10 years. 
  ''')
-Casualties = Gas_Dist_Acc[(Gas_Dist_Acc['FATALITY_IND']=='YES')|(Gas_Dist_Acc['INJURY_IND']=='YES')]
-Casualties_by_State = Casualties.groupby(['LOCATION_STATE_ABBREVIATION', 'CAUSE', 'CAUSE_DETAILS']).sum()
-Casualties_by_State= Casualties_by_State.reset_index()
-Casualties_by_State.rename(columns = {'LOCATION_STATE_ABBREVIATION':'State',
-                                    'FATAL':'Number_Fatalities',
-                                    'CAUSE': 'Cause',
-                                    'CAUSE_DETAILS': 'Cause Details',
-                                    'INJURE':'Number_Injuried'}, inplace=True)
-
-
-Casualties_by_State['Cause'] = Casualties_by_State['Cause'].str.lower().str.capitalize()
-Casualties_by_State['Cause Details'] = Casualties_by_State['Cause Details'].str.lower().str.capitalize()
-Casualties_by_State['Casualties'] = Casualties_by_State['Number_Fatalities']+Casualties_by_State['Number_Injuried']
-fig = px.bar(data_frame=Casualties_by_State, y ='Casualties' , x ='State' , color ='Cause' , #hover_data='CAUSE_DETAILS',
-            color_discrete_sequence= px.colors.sequential.Jet, orientation='v',
-            hover_data={'Cause Details'},
-            title='Casualties of Gas Distribution Line Incidents in Past 10 Years')
-fig.update_layout(showlegend=True)
-st.plotly_chart(fig)
-
-st.write(''' As can be seen form the figure above, th State of New York has the highest number of casualties
+    figure_store.plotly_chart(casualty_figs['casualties_bar'])
+
+    st.write(''' As can be seen form the figure above, th State of New York has the highest number of casualties
 for gas distribution pipe related incidents in the last 10 years. We can compare that with the incident data for the 
 same gas distribution pipeline, where the State of California had the highest number. We can also use a map to show the worst 
 States in terms of the total casualties in the last 10 years:
 ''')
-Casualties_by_State =Casualties_by_State.groupby(['State']).sum().reset_index() #grouping based on States only for the heatmap
-#Plotting the heatmap
-fig = px.choropleth(Casualties_by_State,
-                    locations='State', 
-                    locationmode="USA-states", 
-                    scope="usa",
-                    color='Casualties',
-                    color_continuous_scale="speed", 
-                    )
-
-fig.update_layout(margin={"r":0,"t":0,"l":0,"b":0})
-st.plotly_chart(fig)
+    figure_store.plotly_chart(casualty_figs['casualties_choropleth'])
+
+
+def crossfilter_section():
+    st.write('''
+# Cross Filtering the Gas Distribution Incidents
+Select years, states, causes and whether the incidents had fatalities or injuries. Each chart shows the incidents 
+matching the selections on the others, so they all follow a selection, and the numbers next to the options are the 
+incidents each of them would add.
+''')
+    cf = incident_crossfilter(dist_stamp)
+    # the selections of this run are in the widget states already, the option counts below are computed from them
+    selections = {dim: st.session_state.get('crossfilter_' + dim, []) for dim in crossfilter.DIMENSIONS}
+    for column, dim in zip(st.columns(len(crossfilter.DIMENSIONS)), crossfilter.DIMENSIONS):
+        counts = dict(zip(cf.values[dim], cf.counts(dim, selections)))
+        column.multiselect(CROSSFILTER_TITLES[dim], cf.values[dim], key='crossfilter_' + dim,
+                           format_func=lambda v, dim=dim, counts=counts: '%s (%d)' % (crossfilter_label(dim, v), counts[v]))
+
+    key = crossfilter.selection_key(selections)
+    summary = cf.summary(selections)
+    st.write('%d incidents selected, with %d fatalities and %d injuries.' % (summary['incidents'], summary['fatal'], summary['injure']))
+    figure_store.plotly_chart(crossfilter_bar_figure(dist_stamp, 'year', key))
+    figure_store.plotly_chart(crossfilter_bar_figure(dist_stamp, 'cause', key))
+    st.write('''### Casualties per state''')
+    figure_store.plotly_chart(crossfilter_state_figure(dist_stamp, crossfilter.selection_key(selections, exclude='state')))
+    map_figure = crossfilter_map_figure(dist_stamp, key)
+    if map_figure:
+        figure_store.plotly_chart(map_figure)
+
+
+def trends_section():
+    st.write('''
+# Trends and Spikes
+The incidents of both networks in rolling windows, by state, operator and cause. A window is flagged when its incidents 
+or casualties are well above what the history of the same state, operator or cause before it would give for a window 
+of that length.
+''')
+    window = st.selectbox('Window', list(TREND_WINDOWS), index=1, key='trend_window')
+    stream = trend_stream(cube_stamp, TREND_WINDOWS[window])
+    trend_figs = trend_figures(cube_stamp, TREND_WINDOWS[window])
+    figure_store.plotly_chart(trend_figs['series'])
+
+    st.write('### Spiking in the last %d days, up to %s' % (TREND_WINDOWS[window], stream.time.strftime('%d %B %Y')))
+    spiking = stream.current(anomalous_only=True)
+    if len(spiking):
+        st.dataframe(spiking.drop(columns='anomalous').round(2))
+    else:
+        st.write('Nothing is above its history in this window.')
+    figure_store.plotly_chart(trend_figs['alerts'])
+
+    st.write('''### Busiest windows''')
+    dimension = st.selectbox('By', trends.DIMENSIONS, format_func=str.capitalize, key='trend_dimension')
+    st.dataframe(stream.current(dimension).drop(columns='dimension').sort_values('incidents', ascending=False).round(2))
+
+
+# Warming the caches of the sections that are not open, in a background thread started after the first section has
+# been sent, so opening another section doesn't have to wait for its data (a section opened before the thread got to
+# it waits for the same cache entry instead of computing it again).
+def warm_up(cube_stamp, segments_stamp):
+    load_filtered_incidents(TRANS_INCIDENTS, cube_stamp[0])
+    transmission_figures(cube_stamp)
+    distribution_figures(cube_stamp)
+    incident_map_figure(cube_stamp[1], geo_lod.FULL_VIEW)
+    incident_crossfilter(cube_stamp[1])
+    trend_figures(cube_stamp, TREND_WINDOWS['Quarter'])
+    casualty_figures(cube_stamp)
+    incidents_near_transmission(cube_stamp[1], segments_stamp[1], geo_lod.FULL_VIEW, NEAR_KM)
+    nearby_map_figure(cube_stamp[1], segments_stamp[1], geo_lod.FULL_VIEW, NEAR_KM)
+    pipeline_map_figure(segments_stamp, geo_lod.FULL_VIEW)
+
+
+@st.cache_resource(ttl=CACHE_TTL, max_entries=CACHE_ENTRIES, show_spinner=False)
+def background_loading(cube_stamp, segments_stamp):
+    # once per data version, for all the sessions. Not a daemon thread, a shutdown waits for it to finish instead of
+    # killing it in the middle of a pandas/pyarrow call (which aborts the process)
+    thread = threading.Thread(target=warm_up, args=(cube_stamp, segments_stamp))
+    add_script_run_ctx(thread) # the cached functions look for the script context
+    thread.start()
+    return thread
+
+
+# Each section only loads its data and builds its figures when it is opened
+SECTIONS = {'Pipeline map': pipeline_map_section,
+            'Transmission incidents': transmission_section,
+            'Distribution incidents': distribution_section,
+            'Casualties': casualties_section,
+            'Cross filter': crossfilter_section,
+            'Trends': trends_section}
+section = st.radio('Section', list(SECTIONS), horizontal=True, label_visibility='collapsed')
+SECTIONS[section]()
 
 st.write(''' 
 # Conclusions
@@ -407,4 +533,6 @@ higher incident and casualty rate. California has the highest number of gas dist
 incidents in the last 10 years followed by New York; however, in terms of casualties, 
 the State of New York has the highest number of casualties. The main contributor to the 
 incidents resulting in casualties is natural force damage due to earth movement.
-''')
\ No newline at end of file
+''')
+
+background_loading(cube_stamp, stamp(GEO_DF, GEO_DF_TRANS))
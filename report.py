@@ -0,0 +1,213 @@
+# Headless reports of the incident analytics: the tables and figures of the webapp for any selection of the incidents
+# (a date range, a set of states, the commodities released), made in bulk for the regulatory packs.
+# Each report is a directory with report.html (the tables and the interactive figures), a csv per table and the
+# selected incidents, and a png per figure with --png (needs kaleido). The reports are made in parallel by a process
+# pool. The workers read the incident frames from the shared store (shared_store.py), memory mapped, so the data is
+# loaded once and shared by all the workers and reports instead of being parsed again for each of them.
+#
+#   python report.py --from 2015-01-01 --to 2020-12-31 --states CA NY --commodity "NATURAL GAS"
+#   python report.py --per-state --out reports/states     # a pack with one report per state
+#   python report.py --spec pack.json                      # the selections listed in a json file
+
+import argparse
+import html
+import json
+import os
+import re
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import plotly.io as pio
+import plotly.offline
+
+import cube
+import figures
+import geo_lod
+import incidents
+import shared_store
+
+try:
+    import kaleido  # noqa: F401  png export of the figures
+    HAVE_KALEIDO = True
+except ImportError:
+    HAVE_KALEIDO = False
+
+OUT_DIR = 'reports'
+PLOTLY_JS = 'plotly.min.js' # written once in the output directory, the reports load it from there
+
+# The incidents of a report: LOCAL_DATETIME from start to end (dates, both included), in the states (the state of the
+# operator for the transmission incidents, like the cube) and with COMMODITY_RELEASED_TYPE in commodities.
+# None selects everything.
+Selection = namedtuple('Selection', ['start', 'end', 'states', 'commodities'], defaults=[None, None, None, None])
+
+
+def selection_name(selection):
+    '''Directory name of a report, e.g. CA-NY_2015-01-01_2020-12-31_natural-gas, "all" when nothing is selected.'''
+    parts = []
+    if selection.states:
+        parts.append('-'.join(sorted(selection.states)))
+    if selection.start or selection.end:
+        parts.append('%s_%s' % (selection.start or 'start', selection.end or 'end'))
+    if selection.commodities:
+        parts.append('-'.join(sorted(selection.commodities)))
+    return re.sub(r'[^A-Za-z0-9_.-]+', '-', '_'.join(parts)).lower().strip('-') or 'all'
+
+
+def select(df, dataset, selection):
+    '''The incidents of a dataset in the selection.'''
+    mask = pd.Series(True, index=df.index)
+    if selection.start:
+        mask &= df['LOCAL_DATETIME'] >= pd.Timestamp(selection.start)
+    if selection.end:
+        mask &= df['LOCAL_DATETIME'] < pd.Timestamp(selection.end) + pd.Timedelta(days=1)
+    if selection.states:
+        mask &= df[cube.STATE_COLUMNS[dataset]].isin(selection.states)
+    if selection.commodities:
+        mask &= df['COMMODITY_RELEASED_TYPE'].isin(selection.commodities)
+    return df[mask]
+
+
+def build_report(frames, selection):
+    '''The tables and figures of the webapp for the selected incidents of frames ({dataset name: incident frame}).
+
+    Returns the selected frames, {name: table} and {name: figure}, a figure is left out when it has nothing to show.
+    '''
+    selected = {name: select(df, name, selection) for name, df in frames.items()}
+    incident_cube = cube.Cube(selected)
+    trans_year_state = incidents.year_state_counts(incident_cube, 'transmission')
+    acc_cause = incidents.cause_counts(incident_cube, 'transmission')
+    dist_year_state = incidents.year_state_counts(incident_cube, 'distribution')
+    by_state = incidents.casualties_by_state(incident_cube, 'distribution')
+    tables = {'transmission_casualties': incidents.casualty_totals(incident_cube, 'transmission'),
+              'transmission_year_state': trans_year_state,
+              'transmission_causes': acc_cause,
+              'distribution_casualties': incidents.casualty_totals(incident_cube, 'distribution'),
+              'distribution_year_state': dist_year_state,
+              'distribution_casualties_by_state': by_state}
+
+    figs = {}
+    if len(trans_year_state):
+        figs['transmission_year_state'] = figures.transmission_year_state_bar(trans_year_state)
+    if len(acc_cause):
+        figs['cause_bar'] = figures.cause_bar(acc_cause)
+        figs['cause_pie'] = figures.cause_pie(acc_cause)
+    dist = selected['distribution']
+    if len(dist):
+        # zoomed to the incidents when they are in a few states, binned like the app's map when there are many
+        fit_view = bool(selection.states)
+        if len(dist) > incidents.MAX_MAP_POINTS:
+            bins = incidents.binned(dist, incidents.bin_size(geo_lod.VIEWS[geo_lod.FULL_VIEW]))
+            figs['incident_map'] = figures.incident_density_map(bins, fit_view)
+        else:
+            figs['incident_map'] = figures.incident_map(dist, incidents.hover_text(dist), fit_view)
+    if len(dist_year_state):
+        figs['distribution_year_state'] = figures.distribution_year_state_bar(dist_year_state)
+        figs['year_state_choropleth'] = figures.year_state_choropleth(dist_year_state)
+    if len(by_state):
+        figs['casualties_bar'] = figures.casualties_bar(by_state)
+        figs['casualties_choropleth'] = figures.casualties_choropleth(incidents.casualties_per_state(by_state))
+    return selected, tables, figs
+
+
+def _describe(selection):
+    return ', '.join('%s: %s' % (field, ', '.join(value) if isinstance(value, (list, tuple)) else value)
+                     for field, value in selection._asdict().items() if value) or 'all incidents'
+
+
+def write_report(path, selection, selected, tables, figs, formats):
+    '''Writes a report made by build_report into the directory path.'''
+    os.makedirs(path, exist_ok=True)
+    if 'csv' in formats:
+        for name, table in tables.items():
+            table.to_csv(os.path.join(path, name + '.csv'), index=not isinstance(table.index, pd.RangeIndex))
+        for name, df in selected.items():
+            df.to_csv(os.path.join(path, name + '_incidents.csv'), index=False)
+    if 'png' in formats:
+        for name, fig in figs.items():
+            fig.write_image(os.path.join(path, name + '.png'))
+    if 'html' in formats:
+        parts = ['<h1>Gas pipeline incidents</h1>', '<p>%s</p>' % html.escape(_describe(selection)),
+                 '<p>%s</p>' % ', '.join('%d %s incidents' % (len(df), name) for name, df in selected.items())]
+        for name, table in tables.items():
+            parts += ['<h2>%s</h2>' % name.replace('_', ' ').capitalize(), table.to_html(border=0)]
+        for name, fig in figs.items():
+            parts.append(pio.to_html(fig, full_html=False, include_plotlyjs=False))
+        with open(os.path.join(path, 'report.html'), 'w') as f:
+            f.write('<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>%s</title>'
+                    '<script src="../%s"></script></head>\n<body>\n%s\n</body></html>\n'
+                    % (html.escape(selection_name(selection)), PLOTLY_JS, '\n'.join(parts)))
+    return path
+
+
+# The incident frames of a worker process, mapped from the shared store once and used for all its reports
+_frames = None
+
+
+def _init_worker(version, store_dir):
+    global _frames
+    store = shared_store.SharedStore(version, store_dir)
+    _frames = {name: store.incidents(csv_path) for name, (csv_path, _) in shared_store.INCIDENT_DATASETS.items()}
+
+
+def _make_report(selection, out_dir, formats):
+    path = os.path.join(out_dir, selection_name(selection))
+    return write_report(path, selection, *build_report(_frames, selection), formats)
+
+
+def make_reports(selections, out_dir=OUT_DIR, formats=('html', 'csv'), workers=None,
+                 store_dir=shared_store.STORE_DIR):
+    '''Makes a report for each selection in parallel, yields the directories as they are written.'''
+    version, _ = shared_store.build(store_dir)
+    os.makedirs(out_dir, exist_ok=True)
+    if 'html' in formats:
+        with open(os.path.join(out_dir, PLOTLY_JS), 'w') as f:
+            f.write(plotly.offline.get_plotlyjs())
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(version, store_dir)) as pool:
+        futures = [pool.submit(_make_report, selection, out_dir, formats) for selection in selections]
+        for future in futures:
+            yield future.result()
+
+
+def all_states(store_dir=shared_store.STORE_DIR):
+    '''The states with incidents in any of the datasets.'''
+    store = shared_store.SharedStore(shared_store.build(store_dir)[0], store_dir)
+    states = set()
+    for name, (csv_path, _) in shared_store.INCIDENT_DATASETS.items():
+        states.update(store.incidents(csv_path)[cube.STATE_COLUMNS[name]].dropna().unique())
+    return sorted(states)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write the incident reports of the webapp for selections of the incidents.')
+    parser.add_argument('--from', dest='start', metavar='DATE', help='first day of the incidents, e.g. 2015-01-01')
+    parser.add_argument('--to', dest='end', metavar='DATE', help='last day of the incidents')
+    parser.add_argument('--states', nargs='+', metavar='STATE', help='state abbreviations')
+    parser.add_argument('--commodity', nargs='+', dest='commodities', help='COMMODITY_RELEASED_TYPE values, e.g. "NATURAL GAS"')
+    parser.add_argument('--per-state', action='store_true', help='a report per state (with the other selections applied)')
+    parser.add_argument('--spec', help='json file with a list of selections, e.g. [{"states": ["CA"], "start": "2020-01-01"}]')
+    parser.add_argument('--out', default=OUT_DIR)
+    parser.add_argument('--png', action='store_true', help='a png of each figure too (needs kaleido)')
+    parser.add_argument('--no-html', action='store_true')
+    parser.add_argument('--no-csv', action='store_true')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes (default: number of cpus)')
+    parser.add_argument('--store-dir', default=shared_store.STORE_DIR)
+    args = parser.parse_args()
+    if args.png and not HAVE_KALEIDO:
+        parser.error('kaleido is needed for --png (pip install kaleido)')
+    formats = [f for f, on in [('html', not args.no_html), ('csv', not args.no_csv), ('png', args.png)] if on]
+
+    if args.spec:
+        with open(args.spec) as f:
+            selections = [Selection(**{k: tuple(v) if isinstance(v, list) else v for k, v in s.items()})
+                          for s in json.load(f)]
+    else:
+        base = Selection(args.start, args.end, tuple(args.states or ()) or None, tuple(args.commodities or ()) or None)
+        states = all_states(args.store_dir) if args.per_state else [None]
+        selections = [base._replace(states=(state,)) if state else base for state in states]
+    for path in make_reports(selections, args.out, formats, args.workers, args.store_dir):
+        print(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+# Storage types of the incident and pipeline segment tables.
+# Left to the csv parser most of the incident columns are python strings (names, causes, YES/NO flags) and 64 bit
+# numbers, and the segment frames repeat the operator/pipe name strings on every vertex. The types below are
+# applied when the data is loaded (and kept in the parquet cache), so a session's frames are categoricals,
+# booleans, small integers and float32 coordinates instead.
+
+from fnmatch import fnmatch
+
+import pandas as pd
+
+# Storage type of an incident column by its name (shell pattern), the first match wins:
+#   category   dictionary encoded strings
+#   year       ordered categorical of the years, so .max() and sorting work
+#   flag       YES/NO as a nullable boolean, anything else (e.g. the 'X' placeholders) is missing
+#   date/datetime   parsed with the format PHMSA uses
+#   text       free text, kept as strings
+#   anything else is a pandas dtype
+# Columns that match nothing are dictionary encoded when they are strings and keep the parser's type otherwise.
+SCHEMA = [
+    ('IYEAR', 'year'),
+    ('REPORT_NUMBER', 'int64'),
+    ('SUPPLEMENTAL_NUMBER', 'int64'),
+    ('OPERATOR_ID', 'int64'),
+    ('LOCATION_LATITUDE', 'float32'),
+    ('LOCATION_LONGITUDE', 'float32'),
+    ('FATAL', 'int16'),
+    ('INJURE', 'int16'),
+    ('NUM_*', 'Int32'),
+    ('EST_COST_*_DETAILS', 'text'),
+    ('EST_COST_*', 'float64'),
+    ('*_IND', 'flag'),
+    ('*_DATE', 'date'),
+    ('*_DATETIME', 'datetime'),
+    ('CAUSE_DETAILS', 'category'),
+    ('*_DETAILS', 'text'),
+    ('LOCATION_STREET_ADDRESS', 'text'),
+    ('LOCATION_POSTAL_CODE', 'text'),
+    ('*_STATE_ABBREVIATION', 'category'),
+    ('NAME', 'category'),
+    ('LOCATION_CITY_NAME', 'category'),
+    ('LOCATION_COUNTY_NAME', 'category'),
+    ('CAUSE', 'category'),
+]
+DATE_FORMATS = {'date': '%m/%d/%Y', 'datetime': '%m/%d/%Y %H:%M'}
+FLAG_VALUES = {'YES': True, 'NO': False}
+
+# Dtypes the csv parser can produce directly, the other kinds are converted after parsing
+_PARSE_DTYPES = {'category': 'category', 'year': 'int64', 'flag': str, 'date': str, 'datetime': str, 'text': str}
+
+# Segment frames: the coordinates and the attribute columns repeated on every vertex
+SEGMENT_COORDINATES = ['lats', 'lons']
+
+
+def column_kind(column):
+    '''Storage type of an incident column from the SCHEMA, None when it isn't in it.'''
+    return next((kind for pattern, kind in SCHEMA if fnmatch(column, pattern)), None)
+
+
+def parse_dtypes(columns):
+    '''dtype argument of read_csv for the columns in the SCHEMA.'''
+    dtypes = {}
+    for c in columns:
+        kind = column_kind(c)
+        if kind:
+            dtypes[c] = _PARSE_DTYPES.get(kind, kind)
+    return dtypes
+
+
+def _to_datetime(s, kind):
+    try:
+        return pd.to_datetime(s, format=DATE_FORMATS[kind])
+    except ValueError: # a release with another format, let pandas work it out
+        return pd.to_datetime(s, errors='coerce')
+
+
+def apply_schema(df):
+    '''Converts the columns of an incident frame to their storage types in place and returns the frame.
+
+    Converting a column that already has its type does nothing, so this is also used to restore the types after
+    a parquet read or a concat.
+    '''
+    for c in df.columns:
+        kind = column_kind(c)
+        s = df[c]
+        if kind == 'year':
+            df[c] = pd.Categorical(s, categories=sorted(s.dropna().unique()), ordered=True)
+        elif kind == 'flag':
+            if s.dtype != 'boolean':
+                df[c] = s.map(FLAG_VALUES).astype('boolean')
+        elif kind in DATE_FORMATS:
+            if not pd.api.types.is_datetime64_any_dtype(s):
+                df[c] = _to_datetime(s, kind)
+        elif kind == 'text':
+            if s.dtype != object:
+                df[c] = s.astype(object)
+        elif kind == 'category' or (kind is None and s.dtype == object):
+            if not isinstance(s.dtype, pd.CategoricalDtype):
+                df[c] = s.astype('category')
+        elif kind and s.dtype != kind:
+            df[c] = s.astype(kind)
+    return df
+
+
+def compact_segments(geo_df):
+    '''Segment frame with float32 coordinates (the separator rows are NaN) and dictionary encoded attributes.'''
+    geo_df = geo_df.copy()
+    for c in geo_df.columns:
+        if c in SEGMENT_COORDINATES:
+            geo_df[c] = pd.to_numeric(geo_df[c]).astype('float32')
+        elif geo_df[c].dtype == object:
+            geo_df[c] = geo_df[c].astype('category')
+    return geo_df
@@ -0,0 +1,305 @@
+# Runs the webapp as several streamlit worker processes behind a local load balancer, to use all the cores of a node.
+# A streamlit process runs the scripts of all its sessions in one interpreter, so it doesn't get much past one core.
+# The workers read the prepared data from the shared store (shared_store.py) instead of each loading its own copy,
+# the store is built (or updated when the data changed) before the workers start and then checked every --refresh
+# seconds.
+#
+#   python serve.py --port 8080 --workers 4
+#
+# A browser stays on one worker, its session lives there, through a cookie set on its first request. /ready answers
+# 200 once the store is built and warm and every worker answers its health check, 503 before (for the load balancer
+# or orchestrator in front of the node).
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import secrets
+import signal
+import subprocess
+import sys
+
+import tornado.httpclient
+import tornado.httputil
+import tornado.ioloop
+import tornado.web
+import tornado.websocket
+
+# the same as shared_store.STORE_DIR, which isn't imported so the balancer doesn't load pandas
+STORE_DIR = os.path.join('data', 'cache', 'shared')
+COOKIE = 'pipe_worker'
+HEALTH_INTERVAL = 2 # seconds
+STOP_TIMEOUT = 10 # seconds a worker gets to shut down
+# headers that belong to one connection and aren't passed on
+HOP_HEADERS = {'Connection', 'Keep-Alive', 'Proxy-Authenticate', 'Proxy-Authorization', 'Te', 'Trailers',
+               'Transfer-Encoding', 'Upgrade', 'Content-Length'}
+# response headers tornado sets itself, the worker's replace them rather than being added a second time
+SINGLE_HEADERS = {'Server', 'Date'}
+
+
+def available_cpus():
+    '''CPUs this process may use: its affinity, capped by the cgroup CPU quota of the container.
+
+    os.cpu_count() is the host's count, on Cloud Run or kubernetes a 1-2 vCPU container would start a worker for
+    every core of the node.
+    '''
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+    try: # cgroup v2
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()[:2]
+    except (OSError, ValueError):
+        try: # cgroup v1
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f, open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as g:
+                quota, period = f.read().strip(), g.read().strip()
+        except OSError:
+            quota, period = 'max', '1'
+    if quota not in ('max', '-1'):
+        cpus = min(cpus, math.ceil(int(quota) / int(period)))
+    return max(1, cpus)
+
+
+def store_version(store_dir):
+    try:
+        with open(os.path.join(store_dir, 'current.json')) as f:
+            return json.load(f)['version']
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+class Worker:
+    '''A streamlit process serving the app on a local port.'''
+
+    def __init__(self, index, port, env):
+        self.index = index
+        self.port = port
+        self.env = env
+        self.process = None
+        self.healthy = False
+        self.sessions = 0 # open websocket connections
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.port
+
+    def start(self):
+        self.healthy = False
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'streamlit', 'run', 'pipe-app.py', '--server.port', str(self.port),
+             '--server.address', '127.0.0.1', '--server.headless', 'true', '--server.fileWatcherType', 'none',
+             '--browser.gatherUsageStats', 'false'], env=self.env)
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(STOP_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+
+class Balancer:
+    '''The workers, their health and the version of the shared store.'''
+
+    def __init__(self, workers, store_dir):
+        self.workers = workers
+        self.store_dir = store_dir
+        self.version = None # set once the store is built and warm
+        self.http = tornado.httpclient.AsyncHTTPClient()
+
+    def ready(self):
+        return self.version is not None and all(w.healthy for w in self.workers)
+
+    def pick(self, request):
+        '''The worker of the browser while it's healthy, otherwise the healthy one with the fewest sessions.'''
+        try:
+            worker = self.workers[int(request.cookies[COOKIE].value)]
+            if worker.healthy:
+                return worker
+        except (KeyError, ValueError, IndexError):
+            pass
+        healthy = [w for w in self.workers if w.healthy]
+        return min(healthy, key=lambda w: w.sessions) if healthy else None
+
+    async def check_workers(self):
+        for w in self.workers:
+            if w.process.poll() is not None:
+                print('worker %d exited with %d, restarting' % (w.index, w.process.returncode))
+                w.start()
+                continue
+            try:
+                response = await self.http.fetch(w.url + '/_stcore/health', request_timeout=HEALTH_INTERVAL)
+                w.healthy = response.code == 200
+            except Exception:  # not up yet, or hanging
+                w.healthy = False
+
+    async def refresh_store(self):
+        # shared_store.py builds a new version when the data changed and reads it into the page cache. It runs in its
+        # own process so the balancer doesn't hold the data, the workers pick the new version up on their next run.
+        process = await asyncio.create_subprocess_exec(sys.executable, 'shared_store.py', '--store-dir', self.store_dir)
+        if await process.wait() == 0:
+            self.version = store_version(self.store_dir)
+        else:
+            print('building the shared store failed, still serving %s' % self.version)
+        return self.version
+
+
+class ReadyHandler(tornado.web.RequestHandler):
+
+    def initialize(self, balancer):
+        self.balancer = balancer
+
+    def get(self):
+        self.set_status(200 if self.balancer.ready() else 503)
+        self.write({'store': self.balancer.version,
+                    'workers': [{'port': w.port, 'healthy': w.healthy, 'sessions': w.sessions}
+                                for w in self.balancer.workers]})
+
+
+class ProxyHandler(tornado.web.RequestHandler):
+    '''Passes a request on to the worker of the browser (the page, the static files, the health check...).'''
+
+    SUPPORTED_METHODS = ('GET', 'HEAD', 'POST', 'PUT', 'DELETE', 'PATCH', 'OPTIONS')
+
+    def initialize(self, balancer):
+        self.balancer = balancer
+
+    async def _proxy(self):
+        worker = self.balancer.pick(self.request)
+        if worker is None:
+            raise tornado.web.HTTPError(503)
+        headers = tornado.httputil.HTTPHeaders()
+        for name, value in self.request.headers.get_all():
+            if name not in HOP_HEADERS:
+                headers.add(name, value)
+        headers['X-Forwarded-For'] = self.request.remote_ip
+        response = await self.balancer.http.fetch(
+            worker.url + self.request.uri, method=self.request.method, headers=headers,
+            body=self.request.body if self.request.method in ('POST', 'PUT', 'PATCH') else None,
+            allow_nonstandard_methods=True, follow_redirects=False, decompress_response=False, raise_error=False)
+        if response.code == 599: # no response at all
+            raise tornado.web.HTTPError(502)
+        self.set_status(response.code, response.reason)
+        self.clear_header('Content-Type')
+        for name, value in response.headers.get_all():
+            if name in SINGLE_HEADERS:
+                self.set_header(name, value)
+            elif name not in HOP_HEADERS:
+                self.add_header(name, value)
+        if self.get_cookie(COOKIE) != str(worker.index):
+            self.set_cookie(COOKIE, str(worker.index), httponly=True)
+        if response.body and response.code != 304:
+            self.write(response.body)
+
+    get = head = post = put = delete = patch = options = _proxy
+
+
+class StreamProxy(tornado.websocket.WebSocketHandler):
+    '''Connects the websocket of a session to its worker and passes the messages both ways.'''
+
+    def initialize(self, balancer):
+        self.balancer = balancer
+        self.worker = None
+        self.upstream = None
+
+    def check_origin(self, origin):
+        return True # the request goes on with its Origin and Host, the worker checks them
+
+    def get_compression_options(self):
+        return {} # like --server.enableWebsocketCompression, the figure JSON compresses well
+
+    def select_subprotocol(self, subprotocols):
+        # streamlit passes its session id in the subprotocols, they go on to the worker as they are
+        self.subprotocols = subprotocols
+        return subprotocols[0] if subprotocols else None
+
+    async def open(self):
+        worker = self.balancer.pick(self.request)
+        if worker is None:
+            self.close(1013, 'no worker ready')
+            return
+        headers = tornado.httputil.HTTPHeaders()
+        for name, value in self.request.headers.get_all():
+            if name not in HOP_HEADERS and not name.startswith('Sec-Websocket'):
+                headers.add(name, value)
+        request = tornado.httpclient.HTTPRequest(worker.url.replace('http', 'ws', 1) + self.request.uri, headers=headers)
+        try:
+            self.upstream = await tornado.websocket.websocket_connect(
+                request, on_message_callback=self.on_upstream_message, subprotocols=self.subprotocols or None)
+        except Exception as e:
+            print('worker %d refused a session: %s' % (worker.index, e))
+            self.close(1011, 'worker unavailable')
+            return
+        self.worker = worker
+        worker.sessions += 1
+
+    def on_upstream_message(self, message):
+        if message is None: # the worker closed the session
+            self.close()
+            return
+        try:
+            self.write_message(message, binary=isinstance(message, bytes))
+        except tornado.websocket.WebSocketClosedError:
+            pass
+
+    def on_message(self, message):
+        if self.upstream:
+            self.upstream.write_message(message, binary=isinstance(message, bytes))
+
+    def on_close(self):
+        if self.upstream:
+            self.upstream.close()
+            self.upstream = None
+        if self.worker:
+            self.worker.sessions -= 1
+            self.worker = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the webapp from several worker processes behind a load balancer.')
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', 8080)))
+    parser.add_argument('--workers', type=int, default=available_cpus(), help='default: number of cpus of the container')
+    parser.add_argument('--worker-port', type=int, default=8501, help='port of the first worker, the others follow')
+    parser.add_argument('--store-dir', default=STORE_DIR)
+    parser.add_argument('--refresh', type=float, default=300, help='seconds between the checks for new data')
+    args = parser.parse_args()
+
+    # one cookie secret for all the workers, so a browser moved to another worker (a restart) keeps a valid xsrf cookie
+    env = dict(os.environ, PIPE_SHARED_STORE=os.path.abspath(args.store_dir),
+               STREAMLIT_SERVER_COOKIE_SECRET=os.environ.get('STREAMLIT_SERVER_COOKIE_SECRET', secrets.token_hex(16)))
+    workers = [Worker(i, args.worker_port + i, env) for i in range(args.workers)]
+    balancer = Balancer(workers, args.store_dir)
+    app = tornado.web.Application([
+        (r'/ready', ReadyHandler, {'balancer': balancer}),
+        (r'/_stcore/stream', StreamProxy, {'balancer': balancer}),
+        (r'.*', ProxyHandler, {'balancer': balancer}),
+    ])
+    loop = tornado.ioloop.IOLoop.current()
+
+    async def start():
+        app.listen(args.port) # /ready answers 503 while the store is built
+        if await balancer.refresh_store() is None:
+            print('no shared store, giving up')
+            loop.stop()
+            return
+        for w in workers:
+            w.start()
+        tornado.ioloop.PeriodicCallback(balancer.check_workers, HEALTH_INTERVAL*1000).start()
+        tornado.ioloop.PeriodicCallback(balancer.refresh_store, args.refresh*1000).start()
+        print('serving on port %d with %d workers' % (args.port, len(workers)))
+
+    def shutdown():
+        for w in workers:
+            w.stop()
+        loop.stop()
+
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, lambda *_: loop.add_callback_from_signal(shutdown))
+    loop.add_callback(start)
+    loop.start()
+    if balancer.version is None:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
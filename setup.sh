@@ -5,5 +5,6 @@ echo "\
 port = $PORT\n\
 enableCORS = false\n\
 headless = true\n\
+enableWebsocketCompression = true\n\
 \n\
 " > ~/.streamlit/config.toml
\ No newline at end of file
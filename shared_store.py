@@ -0,0 +1,210 @@
+# Read-only data store shared by the app worker processes (see serve.py).
+# On its own every streamlit process parses, filters and aggregates the data and keeps its own copy of the frames.
+# The store holds the prepared incident frames, the segment frames and the cuboids of the incident cube as
+# uncompressed Arrow IPC files that the workers memory map. The columns without missing values (the coordinates,
+# counts, years, most of the categoricals) are used in place, so their pages are shared by all the workers
+# through the page cache instead of being copied into each of them.
+# Each version of the store is written into its own directory and then published by replacing current.json, a
+# worker always reads a complete version and keeps reading it until it moves on to the next one. The cube of a new
+# version is the cube of the published one with the changed reports applied (see ingest.diff and cube.Cube.apply).
+#
+#   python shared_store.py      # build the store if the data changed, then read it into the page cache
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.ipc
+
+import cube
+import incidents
+from ingest import diff, file_stamp, load_incidents, read_required_columns, unique_keys
+from schema import compact_segments
+
+STORE_DIR = os.path.join('data', 'cache', 'shared')
+CURRENT = 'current.json' # the published version
+MANIFEST = 'manifest.json' # the files of a version, in its directory
+FORMAT = 1 # part of the version, bump it when the layout of the store changes
+KEEP_VERSIONS = 2 # the published version and the one before, which the workers may still be reading
+
+# The incident datasets by the name the cube knows them by, and the segment pickles
+INCIDENT_DATASETS = {
+    'transmission': ('data/incident_gas_transmission_gathering_jan2010_present.csv', 'data/Gas_Trans_required_columns.txt'),
+    'distribution': ('data/incident_gas_distribution_jan2010_present.csv', 'data/Gas_Dist_required_columns.txt'),
+}
+SEGMENT_FILES = ['geo_df.pkl', 'geo_df_trans.pkl']
+
+
+def source_version(datasets=INCIDENT_DATASETS, segment_files=SEGMENT_FILES):
+    '''Version of the store for the current source files, from their stamps.'''
+    paths = [p for dataset in datasets.values() for p in dataset] + list(segment_files)
+    stamps = json.dumps([FORMAT] + [(p, file_stamp(p)) for p in paths])
+    return hashlib.sha1(stamps.encode()).hexdigest()[:16]
+
+
+def current_version(store_dir=STORE_DIR):
+    '''The published version, None before the store is built.'''
+    try:
+        with open(os.path.join(store_dir, CURRENT)) as f:
+            return json.load(f)['version']
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def _table(df, preserve_index=None):
+    table = pa.Table.from_pandas(df, preserve_index=preserve_index)
+    # NaN would become a null, which makes the column a copy when it's read back, NaN is fine for floats
+    for i, name in enumerate(table.column_names):
+        if name in df.columns and df[name].dtype.kind == 'f':
+            table = table.set_column(i, table.field(i), pa.array(df[name].to_numpy()))
+    return table
+
+
+def _write(table, path):
+    with pa.OSFile(path, 'wb') as f:
+        with pa.ipc.new_file(f, table.schema) as writer:
+            writer.write_table(table)
+
+
+def _cuboid_file(dims):
+    return 'cube-%s.arrow' % ('+'.join(sorted(dims)) or 'total')
+
+
+def build(store_dir=STORE_DIR, datasets=INCIDENT_DATASETS, segment_files=SEGMENT_FILES):
+    '''Writes and publishes the store for the current source files, returns its version and whether it was built.'''
+    version = source_version(datasets, segment_files)
+    if version == current_version(store_dir) and os.path.exists(os.path.join(store_dir, version, MANIFEST)):
+        return version, False
+
+    tmp_dir = os.path.join(store_dir, version + '.tmp')
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    manifest = {'version': version, 'format': FORMAT, 'incidents': {}, 'segments': {}, 'cuboids': {}}
+    # the incident frames as the app uses them: filtered to the continental USA, with the key columns the cube needs
+    frames = {}
+    for name, (csv_path, columns_path) in datasets.items():
+        frames[name] = incidents.filter_continental(load_incidents(csv_path, columns_path, keys=True))
+        _write(_table(frames[name], preserve_index=True), os.path.join(tmp_dir, 'incidents-%s.arrow' % name))
+        manifest['incidents'][csv_path] = {'file': 'incidents-%s.arrow' % name,
+                                           'columns': read_required_columns(columns_path)}
+    for path in segment_files:
+        file = 'segments-%s.arrow' % os.path.splitext(os.path.basename(path))[0]
+        _write(_table(compact_segments(pd.read_pickle(path))), os.path.join(tmp_dir, file))
+        manifest['segments'][path] = file
+    for dims, cuboid in _cube(store_dir, frames, manifest['incidents']).cuboids.items():
+        _write(_table(cuboid, preserve_index=bool(dims)), os.path.join(tmp_dir, _cuboid_file(dims)))
+        manifest['cuboids'][_cuboid_file(dims)] = sorted(dims)
+    with open(os.path.join(tmp_dir, MANIFEST), 'w') as f:
+        json.dump(manifest, f)
+
+    version_dir = os.path.join(store_dir, version)
+    shutil.rmtree(version_dir, ignore_errors=True)
+    os.replace(tmp_dir, version_dir)
+    # publish it, a reader sees either the old or the new current.json
+    tmp_path = os.path.join(store_dir, CURRENT + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump({'version': version}, f)
+    os.replace(tmp_path, os.path.join(store_dir, CURRENT))
+    _prune(store_dir)
+    return version, True
+
+
+def _cube(store_dir, frames, incident_files):
+    # Like the app, only the reports that changed since the published version are applied to its cube, it's only
+    # aggregated from scratch when there is no previous version of the same format and columns, or the keys of the
+    # reports aren't unique
+    previous = current_version(store_dir)
+    try:
+        store = SharedStore(previous, store_dir)
+    except (TypeError, OSError, ValueError):
+        return cube.Cube(frames)
+    if store.manifest.get('format') != FORMAT or any(
+            store.manifest['incidents'].get(path, {}).get('columns') != entry['columns']
+            for path, entry in incident_files.items()):
+        return cube.Cube(frames)
+    old_frames = [store.incidents(path, keys=True) for path in incident_files]
+    if not all(map(unique_keys, [*frames.values(), *old_frames])):
+        return cube.Cube(frames)
+    incident_cube = store.cube()
+    for (name, df), old in zip(frames.items(), old_frames):
+        removed, added = diff(old, df)
+        if len(removed) or len(added):
+            incident_cube = incident_cube.apply(name, old.iloc[removed], df.iloc[added])
+    return incident_cube
+
+
+def _prune(store_dir):
+    # the oldest versions go, the files of a version a worker still has mapped stay readable until it lets them go
+    versions = sorted((e for e in os.scandir(store_dir) if e.is_dir() and not e.name.endswith('.tmp')),
+                      key=lambda e: e.stat().st_mtime, reverse=True)
+    current = current_version(store_dir)
+    for e in versions[KEEP_VERSIONS:]:
+        if e.name != current:
+            shutil.rmtree(e.path, ignore_errors=True)
+
+
+def warm(store_dir=STORE_DIR, chunk_size=1 << 20):
+    '''Reads the files of the published version once so they're in the page cache, returns the number of bytes.'''
+    version_dir = os.path.join(store_dir, current_version(store_dir))
+    total = 0
+    for e in os.scandir(version_dir):
+        with open(e.path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                total += len(chunk)
+    return total
+
+
+class SharedStore:
+    '''One version of the store, the frames are memory mapped from its files.
+
+    The frames are read only (their arrays aren't writeable), they are shared by everything using them.
+    '''
+
+    def __init__(self, version, store_dir=STORE_DIR):
+        self.version = version
+        self.path = os.path.join(store_dir, version)
+        with open(os.path.join(self.path, MANIFEST)) as f:
+            self.manifest = json.load(f)
+
+    def _frame(self, file, columns=None):
+        table = pa.ipc.open_file(pa.memory_map(os.path.join(self.path, file))).read_all()
+        if columns is not None:
+            index = [c for c in table.schema.pandas_metadata['index_columns'] if isinstance(c, str)]
+            table = table.select(columns + index)
+        # one block per column, so the columns are views of the mapped buffers rather than consolidated copies
+        return table.to_pandas(split_blocks=True)
+
+    def incidents(self, csv_path, keys=False):
+        '''The filtered incident frame of a csv, only the required columns unless keys.'''
+        entry = self.manifest['incidents'][csv_path]
+        return self._frame(entry['file'], None if keys else entry['columns'])
+
+    def segments(self, path):
+        return self._frame(self.manifest['segments'][path])
+
+    def cube(self):
+        cuboids = {frozenset(dims): self._frame(file) for file, dims in self.manifest['cuboids'].items()}
+        return cube.Cube.from_cuboids(cuboids)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the data store shared by the app workers and warm it up.')
+    parser.add_argument('--store-dir', default=STORE_DIR)
+    parser.add_argument('--if-present', action='store_true',
+                        help="do nothing when the data files aren't there (e.g. an image built from a clean checkout)")
+    args = parser.parse_args()
+    missing = [p for dataset in INCIDENT_DATASETS.values() for p in dataset] + SEGMENT_FILES
+    missing = [p for p in missing if not os.path.exists(p)]
+    if missing and args.if_present:
+        print('not built, missing %s' % ', '.join(missing))
+        return
+    version, built = build(args.store_dir)
+    print('%s: %s, %d bytes warm' % (version, 'built' if built else 'up to date', warm(args.store_dir)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+# Spatial index over the incident locations and the pipeline segments.
+# Both indexes bucket their items in a uniform lon/lat grid (sorted cell keys + searchsorted), so bounding box,
+# radius and nearest segment queries only look at the items in the cells around the query instead of the whole table.
+
+import math
+
+import numpy as np
+import pandas as pd
+
+CELL_SIZE = 0.5 # degrees
+KM_PER_DEG_LAT = 110.574
+KM_PER_DEG_LON = 111.320 # at the equator, scaled by cos(latitude)
+EARTH_RADIUS_KM = 6371.0
+
+
+def _cell_keys(cx, cy):
+    # cells are keyed by one integer, the grid only has to cover the lon/lat ranges of the earth
+    return (cx + 1000)*10000 + (cy + 1000)
+
+
+def _cells(lons, lats, cell_size=CELL_SIZE):
+    return (np.floor(np.asarray(lons, dtype=float)/cell_size).astype(np.int64),
+            np.floor(np.asarray(lats, dtype=float)/cell_size).astype(np.int64))
+
+
+def grid_keys(lons, lats, cell_size):
+    '''Key of the grid cell (cell_size degrees) each point falls in, e.g. to bin the points with a groupby.'''
+    return _cell_keys(*_cells(lons, lats, cell_size))
+
+
+def _cos_deg(lat):
+    # cos of the latitude, kept away from 0 near the poles
+    return max(math.cos(math.radians(min(lat, 89.9))), 1e-6)
+
+
+def haversine_km(lon1, lat1, lon2, lat2):
+    lon1, lat1, lon2, lat2 = map(np.radians, (lon1, lat1, lon2, lat2))
+    a = np.sin((lat2 - lat1)/2)**2 + np.cos(lat1)*np.cos(lat2)*np.sin((lon2 - lon1)/2)**2
+    return 2*EARTH_RADIUS_KM*np.arcsin(np.sqrt(a))
+
+
+class _Grid:
+    '''Items bucketed by grid cell, an item can be in several cells.'''
+
+    def __init__(self, keys, items):
+        order = np.argsort(keys, kind='stable')
+        self.keys = keys[order]
+        self.items = items[order]
+
+    def lookup(self, cx_min, cx_max, cy_min, cy_max):
+        '''Items in the cells of the given (inclusive) cell range, without duplicates.'''
+        found = []
+        for cx in range(cx_min, cx_max + 1):
+            lo = np.searchsorted(self.keys, _cell_keys(cx, cy_min), side='left')
+            hi = np.searchsorted(self.keys, _cell_keys(cx, cy_max), side='right')
+            found.append(self.items[lo:hi])
+        return np.unique(np.concatenate(found)) if found else np.array([], dtype=np.int64)
+
+
+class PointIndex:
+    '''Grid index over points, e.g. the LOCATION_LONGITUDE/LOCATION_LATITUDE of the incidents.
+
+    The queries return positions (0..n-1) into the arrays the index was built from, use .iloc with them.
+    '''
+
+    def __init__(self, lons, lats):
+        self.lons = np.asarray(lons, dtype=float)
+        self.lats = np.asarray(lats, dtype=float)
+        valid = np.flatnonzero(~(np.isnan(self.lons) | np.isnan(self.lats)))
+        cx, cy = _cells(self.lons[valid], self.lats[valid])
+        self.grid = _Grid(_cell_keys(cx, cy), valid)
+
+    def bbox(self, lon_min, lon_max, lat_min, lat_max):
+        '''Points inside the bounding box.'''
+        (cx_min, cx_max), (cy_min, cy_max) = _cells([lon_min, lon_max], [lat_min, lat_max])
+        found = self.grid.lookup(cx_min, cx_max, cy_min, cy_max)
+        inside = ((lon_min <= self.lons[found]) & (self.lons[found] <= lon_max)
+                  & (lat_min <= self.lats[found]) & (self.lats[found] <= lat_max))
+        return found[inside]
+
+    def radius(self, lon, lat, km):
+        '''Points within km of (lon, lat), with their distances.'''
+        dlat = km/KM_PER_DEG_LAT
+        dlon = km/(KM_PER_DEG_LON*_cos_deg(abs(lat) + dlat))
+        found = self.bbox(lon - dlon, lon + dlon, lat - dlat, lat + dlat)
+        dist = haversine_km(lon, lat, self.lons[found], self.lats[found])
+        return found[dist <= km], dist[dist <= km]
+
+
+class SegmentIndex:
+    '''Grid index over the segments between consecutive points of a pipeline frame (geo_df/geo_df_trans).
+
+    Each segment is put in every cell its bounding box touches. nearest() returns positions in the frame of the
+    first point of the nearest segment, so the pipe/operator names can be looked up with .iloc.
+    '''
+
+    def __init__(self, geo_df):
+        lats = pd.to_numeric(geo_df['lats']).to_numpy(dtype=float)
+        lons = pd.to_numeric(geo_df['lons']).to_numpy(dtype=float)
+        # a segment between each point and the next one, unless either is a line separator
+        start = np.flatnonzero(~(np.isnan(lats[:-1]) | np.isnan(lats[1:])))
+        self.start = start
+        self.ax, self.ay, self.bx, self.by = lons[start], lats[start], lons[start + 1], lats[start + 1]
+
+        cx0, cy0 = _cells(np.minimum(self.ax, self.bx), np.minimum(self.ay, self.by))
+        cx1, cy1 = _cells(np.maximum(self.ax, self.bx), np.maximum(self.ay, self.by))
+        nx, ny = cx1 - cx0 + 1, cy1 - cy0 + 1
+        segment = np.repeat(np.arange(len(start)), nx*ny)
+        k = np.arange(len(segment)) - np.repeat(np.r_[0, np.cumsum(nx*ny)[:-1]], nx*ny)
+        keys = _cell_keys(cx0[segment] + k//ny[segment], cy0[segment] + k % ny[segment])
+        self.grid = _Grid(keys, segment)
+
+    def _distance_km(self, lons, lats, segments):
+        '''Distance matrix between the points and the segments, on a local equirectangular projection.'''
+        kx = KM_PER_DEG_LON*np.cos(np.radians(lats))[:, None]
+        px, py = lons[:, None]*kx, lats[:, None]*KM_PER_DEG_LAT
+        ax, ay = self.ax[segments]*kx, self.ay[segments]*KM_PER_DEG_LAT
+        bx, by = self.bx[segments]*kx, self.by[segments]*KM_PER_DEG_LAT
+        dx, dy = bx - ax, by - ay
+        length2 = dx*dx + dy*dy
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = np.where(length2 > 0, ((px - ax)*dx + (py - ay)*dy)/length2, 0)
+        t = np.clip(t, 0, 1)
+        return np.hypot(px - (ax + t*dx), py - (ay + t*dy))
+
+    def nearest(self, lons, lats, max_km):
+        '''Nearest segment within max_km of each point.
+
+        Returns the frame position of the segment (-1 if there is none within max_km) and the distance (inf if none).
+        '''
+        lons, lats = np.atleast_1d(np.asarray(lons, dtype=float)), np.atleast_1d(np.asarray(lats, dtype=float))
+        best = np.full(len(lons), -1, dtype=np.int64)
+        best_km = np.full(len(lons), np.inf)
+        valid = ~(np.isnan(lons) | np.isnan(lats))
+        if not len(self.start) or not valid.any():
+            return best, best_km
+        # the points are queried a cell at a time, against the segments in the cells within max_km of it
+        points = np.flatnonzero(valid)
+        cx, cy = _cells(lons[points], lats[points])
+        order = np.argsort(_cell_keys(cx, cy), kind='stable')
+        points, cx, cy = points[order], cx[order], cy[order]
+        _, first = np.unique(_cell_keys(cx, cy), return_index=True)
+        reach_y = int(math.ceil(max_km/KM_PER_DEG_LAT/CELL_SIZE))
+        for lo, hi in zip(first, np.r_[first[1:], len(points)]):
+            qx, qy = cx[lo], cy[lo]
+            lat = max(abs(qy), abs(qy + 1))*CELL_SIZE # the edge of the cell furthest from the equator
+            reach_x = int(math.ceil(max_km/(KM_PER_DEG_LON*_cos_deg(lat))/CELL_SIZE))
+            segments = self.grid.lookup(qx - reach_x, qx + reach_x, qy - reach_y, qy + reach_y)
+            if not len(segments):
+                continue
+            p = points[lo:hi]
+            dist = self._distance_km(lons[p], lats[p], segments)
+            closest = dist.argmin(axis=1)
+            km = dist[np.arange(len(p)), closest]
+            found = km <= max_km
+            best[p[found]] = self.start[segments[closest[found]]]
+            best_km[p[found]] = km[found]
+        return best, best_km
+
+    def within(self, lons, lats, km):
+        '''Mask of the points within km of any segment.'''
+        return self.nearest(lons, lats, km)[0] >= 0
@@ -0,0 +1,7 @@
+# The modules are at the top of the repository and read the data with paths relative to it
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import crossfilter
+import incidents
+from ingest import load_incidents
+
+
+@pytest.fixture(scope='module')
+def df():
+    return incidents.filter_continental(load_incidents('data/incident_gas_distribution_jan2010_present.csv',
+                                                       'data/Gas_Dist_required_columns.txt'))
+
+
+def _mask(df, selections):
+    mask = np.ones(len(df), dtype=bool)
+    for dim, values in selections.items():
+        if values:
+            mask &= df[crossfilter.DIMENSIONS[dim]].isin(values).to_numpy(dtype=bool, na_value=False)
+    return mask
+
+
+@pytest.mark.parametrize('selections', [
+    {},
+    {'state': ['CA', 'NY', 'TX'], 'year': [2015, 2016, 2017]},
+    {'cause': ['EXCAVATION DAMAGE'], 'fatality': [True]},
+    {'state': ['CA'], 'injury': [False]},
+    {'state': ['XX'], 'year': [2015]}, # nothing selected
+])
+def test_bitmaps_match_a_boolean_mask(df, selections):
+    cf = crossfilter.CrossFilter(df)
+    mask = _mask(df, selections)
+    np.testing.assert_array_equal(cf.rows(selections), np.flatnonzero(mask))
+    assert cf.summary(selections) == {'incidents': mask.sum(), 'fatal': df['FATAL'][mask].sum(),
+                                      'injure': df['INJURE'][mask].sum()}
+    for dim, column in crossfilter.DIMENSIONS.items():
+        # each dimension is counted with the selections on the others
+        others = _mask(df, {d: v for d, v in selections.items() if d != dim})
+        expected = df[column][others].value_counts(dropna=False)
+        counts = cf.counts(dim, selections)
+        for value, count in counts.items():
+            if value is None:
+                assert count == df[column][others].isna().sum()
+            else:
+                assert count == expected.get(value, 0)
+        totals = cf.totals(dim, 'fatal', selections)
+        assert totals.sum() == df['FATAL'][others].sum()
+        # memoized answers come back the same
+        pd.testing.assert_series_equal(cf.counts(dim, selections), counts)
@@ -0,0 +1,68 @@
+import pandas as pd
+import pytest
+
+import cube
+import incidents
+from ingest import load_incidents
+
+DATASETS = {
+    'transmission': ('data/incident_gas_transmission_gathering_jan2010_present.csv', 'data/Gas_Trans_required_columns.txt'),
+    'distribution': ('data/incident_gas_distribution_jan2010_present.csv', 'data/Gas_Dist_required_columns.txt'),
+}
+
+
+@pytest.fixture(scope='module')
+def frames():
+    return {name: incidents.filter_continental(load_incidents(*paths, keys=True)) for name, paths in DATASETS.items()}
+
+
+@pytest.fixture(scope='module')
+def base(frames):
+    return pd.concat([cube.facts(name, df) for name, df in frames.items()], ignore_index=True)
+
+
+def _expected(base, by, where):
+    for dim, values in where.items():
+        base = base[base[dim].isin(values if isinstance(values, list) else [values])]
+    if not by:
+        return base[cube.MEASURES].sum().to_frame().T
+    return base.groupby(by, dropna=False)[cube.MEASURES].sum().reset_index()
+
+
+def _sorted(df, by):
+    return df.sort_values(by).reset_index(drop=True) if by else df.reset_index(drop=True)
+
+
+@pytest.mark.parametrize('by, where', [
+    ([], {}),
+    (['year'], {}),
+    (['year'], {'dataset': 'distribution', 'state': ['CA', 'NY']}),
+    (['state', 'cause'], {'dataset': 'transmission'}),
+    (['cause', 'year', 'dataset'], {}),
+    ([], {'year': [2015, 2016], 'cause': 'EXCAVATION DAMAGE'}),
+])
+def test_query_matches_a_groupby(frames, base, by, where):
+    incident_cube = cube.Cube(frames)
+    answer = incident_cube.query(by, **where)
+    pd.testing.assert_frame_equal(_sorted(answer, by), _sorted(_expected(base, by, where), by), check_dtype=False)
+    # the memoized answer is the same, and a copy the caller can change
+    answer['incidents'] = 0
+    pd.testing.assert_frame_equal(_sorted(incident_cube.query(by, **where), by),
+                                  _sorted(_expected(base, by, where), by), check_dtype=False)
+
+
+def test_query_of_an_unknown_dimension(frames):
+    with pytest.raises(KeyError):
+        cube.Cube(frames).query(['county'])
+
+
+def test_apply_matches_a_rebuild(frames):
+    old = {name: df.iloc[40:] for name, df in frames.items()}
+    dist = frames['distribution']
+    removed, added = old['distribution'].iloc[:25], dist.iloc[:40]
+    applied = cube.Cube(old).apply('distribution', removed, added)
+    rebuilt = cube.Cube({'transmission': old['transmission'],
+                         'distribution': pd.concat([dist.iloc[:40], dist.iloc[65:]])})
+    for dims, cuboid in rebuilt.cuboids.items():
+        pd.testing.assert_frame_equal(_sorted(applied.cuboids[dims].reset_index(), sorted(dims)),
+                                      _sorted(cuboid.reset_index(), sorted(dims)), check_dtype=False)
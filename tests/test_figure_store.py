@@ -0,0 +1,27 @@
+import plotly.graph_objects as go
+
+import figure_store
+
+
+class OtherStreamlit:
+    '''A container of a streamlit version without the private _enqueue.'''
+
+    def __init__(self):
+        self.charts = []
+
+    def plotly_chart(self, fig, use_container_width=False, theme='streamlit'):
+        self.charts.append(fig)
+
+
+def test_identical_figures_are_stored_once():
+    store = figure_store.FigureStore()
+    a = store.put(go.Figure(go.Bar(x=[1, 2], y=[3, 4])))
+    assert store.put(go.Figure(go.Bar(x=[1, 2], y=[3, 4]))) is a
+    assert len(store) == 1
+
+
+def test_plotly_chart_falls_back_to_st_plotly_chart():
+    fig = go.Figure(go.Bar(x=['a', 'b'], y=[3, 4]))
+    container = OtherStreamlit()
+    figure_store.plotly_chart(figure_store.FigureStore().put(fig), container)
+    assert [c.to_plotly_json()['data'] for c in container.charts] == [fig.to_plotly_json()['data']]
@@ -0,0 +1,14 @@
+import pandas as pd
+
+import figures
+from schema import compact_segments
+
+
+def test_pipeline_map_of_a_view_without_transmission_lines():
+    geo_df = compact_segments(pd.read_pickle('geo_df.pkl'))
+    geo_df_trans = compact_segments(pd.read_pickle('geo_df_trans.pkl'))
+    # geo_lod.PipelineLOD.frame returns the empty frame for a view without lines
+    fig = figures.pipeline_map(geo_df, geo_df_trans.iloc[:0], fit_view=True)
+    assert len(fig.data) == 1
+    fig = figures.pipeline_map(geo_df.iloc[:0], geo_df_trans.iloc[:0], fit_view=True)
+    assert len(fig.data) == 0
@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import geo_lod
+
+
+@pytest.fixture(scope='module', params=['geo_df.pkl', 'geo_df_trans.pkl'])
+def geo_df(request):
+    return pd.read_pickle(request.param)
+
+
+def _lines(df):
+    lats = pd.to_numeric(df['lats']).to_numpy(dtype=float)
+    lons = pd.to_numeric(df['lons']).to_numpy(dtype=float)
+    return [np.c_[lons[s:e], lats[s:e]] for s, e in zip(*geo_lod.split_lines(lats))]
+
+
+def test_tolerance_zero_keeps_the_original_segments(geo_df):
+    lod = geo_lod.PipelineLOD(geo_df)
+    out = lod.frame(tolerance=0.0)
+    original, kept = _lines(geo_df), _lines(out)
+    assert len(kept) == len(original)
+    for a, b in zip(original, kept):
+        np.testing.assert_array_equal(a, b)
+    # the attributes of the vertices come along
+    vertices = out['lats'].notna()
+    assert (out.loc[vertices].drop(columns=['lats', 'lons']).reset_index(drop=True)
+            .equals(geo_df.loc[geo_df['lats'].notna()].drop(columns=['lats', 'lons']).reset_index(drop=True)))
+
+
+@pytest.mark.parametrize('view', [v for v in geo_lod.VIEWS if v != geo_lod.FULL_VIEW])
+def test_tile_index_finds_every_line_in_a_view(geo_df, view):
+    lod = geo_lod.PipelineLOD(geo_df)
+    lon_min, lon_max, lat_min, lat_max = bbox = geo_lod.VIEWS[view]
+    inside = (lon_min <= lod.lons) & (lod.lons <= lon_max) & (lat_min <= lod.lats) & (lod.lats <= lat_max)
+    expected = np.unique(lod.line_of_row[inside])
+    assert np.isin(expected, lod.lines_in(bbox)).all()
+
+    # and at full detail the frame of the view has every vertex inside it
+    out = lod.frame(bbox, tolerance=0.0)
+    shown = set(zip(out['lons'].dropna().astype(float), out['lats'].dropna().astype(float)))
+    assert set(zip(lod.lons[inside], lod.lats[inside])) <= shown
@@ -0,0 +1,14 @@
+import numpy as np
+import pandas as pd
+
+import incidents
+
+
+def test_hover_text_of_incidents_without_city_or_cause():
+    df = pd.DataFrame({'LOCATION_CITY_NAME': pd.Series([np.nan, np.nan], dtype='category'),
+                       'LOCATION_STATE_ABBREVIATION': ['CA', 'NY'],
+                       'CAUSE': [np.nan, 'EXCAVATION DAMAGE'],
+                       'IYEAR': [2015, 2016]})
+    assert incidents.hover_text(df).isna().all()
+    assert incidents.hover_text(df.iloc[1:].assign(LOCATION_CITY_NAME='NEW YORK')).tolist() == \
+        ['New York, NY, Cause: Excavation damage, 2016']
@@ -0,0 +1,62 @@
+import pandas as pd
+import pytest
+
+import cube
+from ingest import diff, parse_csv, read_required_columns, refresh, stored_columns, update
+
+CSV = 'data/incident_gas_distribution_jan2010_present.csv'
+COLUMNS = 'data/Gas_Dist_required_columns.txt'
+
+
+def _releases(tmp_path):
+    # two releases cut from the real csv: the new one drops reports, adds reports and supersedes a report with a
+    # supplemental that changes its casualties and cause
+    raw = pd.read_csv(CSV, dtype=str, keep_default_na=False).iloc[:300]
+    old = raw.drop(index=range(250, 300))
+    new = raw.drop(index=[3, 17, 120])
+    new.loc[40, 'SUPPLEMENTAL_NUMBER'] = str(int(new.loc[40, 'SUPPLEMENTAL_NUMBER']) + 1)
+    new.loc[40, ['FATAL', 'INJURE', 'CAUSE']] = ['2', '5', 'OTHER INCIDENT CAUSE']
+    paths = tmp_path / 'old.csv', tmp_path / 'new.csv'
+    old.to_csv(paths[0], index=False)
+    new.to_csv(paths[1], index=False)
+    return paths
+
+
+def _sorted_cuboids(incident_cube):
+    return {dims: (c.sort_index() if dims else c).reset_index() for dims, c in incident_cube.cuboids.items()}
+
+
+def test_incremental_update_matches_a_full_parse(tmp_path):
+    old_csv, new_csv = _releases(tmp_path)
+    columns = stored_columns(read_required_columns(COLUMNS))
+    stored = parse_csv(old_csv, columns)
+    rebuilt = parse_csv(new_csv, columns)
+
+    updated, changes = update(stored, new_csv, columns)
+    assert changes == {'inserted': 50, 'updated': 1, 'deleted': 3}
+    pd.testing.assert_frame_equal(updated, rebuilt)
+
+    removed, added = diff(stored, updated)
+    applied = cube.Cube({'distribution': stored}).apply('distribution', stored.iloc[removed], updated.iloc[added])
+    expected = _sorted_cuboids(cube.Cube({'distribution': rebuilt}))
+    actual = _sorted_cuboids(applied)
+    assert actual.keys() == expected.keys()
+    for dims in expected:
+        pd.testing.assert_frame_equal(actual[dims], expected[dims], check_dtype=False)
+
+
+def test_duplicate_keys_rebuild_the_cache(tmp_path):
+    old_csv, new_csv = _releases(tmp_path)
+    raw = pd.read_csv(new_csv, dtype=str, keep_default_na=False)
+    pd.concat([raw, raw.iloc[[10]]]).to_csv(new_csv, index=False) # a report twice in a bad drop
+    columns = stored_columns(read_required_columns(COLUMNS))
+    with pytest.raises(ValueError):
+        update(parse_csv(old_csv, columns), new_csv, columns)
+
+    csv_path, cache_dir = tmp_path / 'release.csv', tmp_path / 'cache'
+    csv_path.write_bytes(old_csv.read_bytes())
+    assert refresh(str(csv_path), COLUMNS, str(cache_dir))[1] == 'rebuilt'
+    csv_path.write_bytes(new_csv.read_bytes())
+    df, changes = refresh(str(csv_path), COLUMNS, str(cache_dir))
+    assert changes == 'rebuilt'
+    assert len(df) == len(raw) + 1
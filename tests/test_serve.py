@@ -0,0 +1,34 @@
+import asyncio
+
+import tornado.httpclient
+import tornado.httpserver
+import tornado.testing
+import tornado.web
+
+import serve
+
+
+class Page(tornado.web.RequestHandler):
+    def get(self):
+        self.set_header('X-Worker', 'yes')
+        self.write('page')
+
+
+def test_proxied_response_has_one_server_and_date_header():
+    async def run():
+        worker_socket, worker_port = tornado.testing.bind_unused_port()
+        tornado.httpserver.HTTPServer(tornado.web.Application([(r'.*', Page)])).add_sockets([worker_socket])
+        worker = serve.Worker(0, worker_port, env={})
+        worker.healthy = True
+        balancer = serve.Balancer([worker], serve.STORE_DIR)
+        socket, port = tornado.testing.bind_unused_port()
+        tornado.httpserver.HTTPServer(tornado.web.Application(
+            [(r'.*', serve.ProxyHandler, {'balancer': balancer})])).add_sockets([socket])
+        return await tornado.httpclient.AsyncHTTPClient().fetch('http://127.0.0.1:%d/' % port)
+
+    response = asyncio.run(run())
+    assert response.body == b'page'
+    assert response.headers.get_list('X-Worker') == ['yes']
+    assert len(response.headers.get_list('Server')) == 1
+    assert len(response.headers.get_list('Date')) == 1
+    assert response.headers['Set-Cookie'].startswith(serve.COOKIE + '=0')
@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+
+import spatial
+
+rng = np.random.default_rng(5)
+
+
+def _points(n=2000):
+    lons = rng.uniform(-104, -96, n)
+    lats = rng.uniform(30, 36, n)
+    lons[::97] = np.nan # missing locations are never found
+    return lons, lats
+
+
+def _lines(n_lines=40, points=12):
+    # random walks separated by a NaN row, like geo_df
+    rows = []
+    for _ in range(n_lines):
+        start = rng.uniform([-104, 30], [-96, 36])
+        rows.append(start + np.cumsum(rng.normal(0, 0.2, (points, 2)), axis=0))
+        rows.append([[np.nan, np.nan]])
+    lonlat = np.concatenate(rows)
+    return pd.DataFrame({'lons': lonlat[:, 0], 'lats': lonlat[:, 1]})
+
+
+def test_bbox_matches_a_scan():
+    lons, lats = _points()
+    index = spatial.PointIndex(lons, lats)
+    # the boxes cross cell edges (CELL_SIZE is 0.5), the last one has no points
+    for box in [(-100.3, -98.7, 31.9, 33.6), (-104, -96, 30, 36), (-99.75, -99.74, 33.21, 33.22), (-80, -79, 40, 41)]:
+        lon_min, lon_max, lat_min, lat_max = box
+        expected = np.flatnonzero((lon_min <= lons) & (lons <= lon_max) & (lat_min <= lats) & (lats <= lat_max))
+        np.testing.assert_array_equal(np.sort(index.bbox(*box)), expected)
+    assert len(index.bbox(-80, -79, 40, 41)) == 0
+
+
+def test_radius_matches_a_scan():
+    lons, lats = _points()
+    index = spatial.PointIndex(lons, lats)
+    for lon, lat, km in [(-100.0, 33.0, 50), (-99.5, 31.5, 120), (-97.01, 35.99, 5), (-80.0, 40.0, 10)]:
+        found, dist = index.radius(lon, lat, km)
+        all_dist = spatial.haversine_km(lon, lat, lons, lats)
+        expected = np.flatnonzero(all_dist <= km)
+        order = np.argsort(found)
+        np.testing.assert_array_equal(found[order], expected)
+        np.testing.assert_allclose(dist[order], all_dist[expected])
+
+
+def test_nearest_matches_a_scan():
+    geo_df = _lines()
+    index = spatial.SegmentIndex(geo_df)
+    lons, lats = _points(500)
+    max_km = 25
+    best, best_km = index.nearest(lons, lats, max_km)
+
+    valid = ~np.isnan(lons)
+    dist = index._distance_km(lons[valid], lats[valid], np.arange(len(index.start)))
+    closest = dist.argmin(axis=1)
+    km = dist[np.arange(len(closest)), closest]
+    expected = np.where(km <= max_km, index.start[closest], -1)
+    np.testing.assert_array_equal(best[valid], expected)
+    np.testing.assert_allclose(best_km[valid], np.where(km <= max_km, km, np.inf))
+    assert (best[~valid] == -1).all()
+    assert (best == -1).any() and (best >= 0).any()
+    # nothing within reach far away from the lines
+    assert index.nearest([-80.0], [40.0], max_km)[0][0] == -1
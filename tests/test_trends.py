@@ -0,0 +1,56 @@
+import pandas as pd
+import pytest
+
+import trends
+
+START = pd.Timestamp('2015-01-01')
+
+
+def _flat_history(stream, days=2*365):
+    # one incident in CA every 30 days, about three per window
+    for day in range(0, days, 30):
+        stream.push(START + pd.Timedelta(days=day), {'state': 'CA'})
+    return START + pd.Timedelta(days=day)
+
+
+def test_a_burst_after_a_flat_history_raises_one_alert():
+    stream = trends.TrendStream()
+    last = _flat_history(stream)
+    assert last - START > trends.WARM_UP + trends.WINDOW
+    assert stream.alerts == []
+    assert not stream.current(anomalous_only=True).size
+
+    for hour in range(8): # eight more in a few days
+        stream.push(last + pd.Timedelta(days=1, hours=hour), {'state': 'CA'}, 1)
+    assert len(stream.alerts) == 1 # when the window became anomalous, not again for each incident of the burst
+    alert = stream.alerts[0]
+    assert (alert.dimension, alert.value) == ('state', 'CA') and alert.incidents >= trends.MIN_COUNT and alert.z >= trends.THRESHOLD
+    spiking = stream.current('state', anomalous_only=True)
+    assert spiking['value'].tolist() == ['CA']
+    assert spiking['incidents'].iloc[0] == stream.keys[('state', 'CA')].incidents
+
+
+def test_no_scores_during_the_warm_up():
+    stream = trends.TrendStream()
+    for hour in range(10):
+        stream.push(START + pd.Timedelta(hours=hour), {'state': 'CA'})
+    assert stream.alerts == []
+    assert stream.current()['z'].isna().all()
+
+
+def test_incidents_out_of_order_are_refused():
+    stream = trends.TrendStream()
+    stream.push(START, {'state': 'CA'})
+    with pytest.raises(ValueError):
+        stream.push(START - pd.Timedelta(minutes=1), {'state': 'CA'})
+
+
+def test_an_expired_incident_goes_into_the_history():
+    stream = trends.TrendStream()
+    stream.push(START, {'state': 'CA', 'cause': None}, casualties=2)
+    stream.push(START + trends.WINDOW + pd.Timedelta(days=1), {'state': 'NY'})
+    ca = stream.keys[('state', 'CA')]
+    assert (ca.incidents, ca.casualties, ca.past_incidents, ca.past_casualties) == (0, 0, 1, 2)
+    assert ('cause', None) not in stream.keys # missing values are left out
+    assert stream.current()['value'].tolist() == ['NY']
+    assert stream.series()[['incidents', 'casualties']].values.tolist() == [[1, 2], [1, 0]]
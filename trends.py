@@ -0,0 +1,176 @@
+# Rolling window trends of the incidents and the windows that spike, for the trends section of the webapp.
+# The incidents are streamed in LOCAL_DATETIME order through a sliding window (a quarter by default). Every incident
+# adds to the window of its state, operator and cause and the incidents that fall out of the window are taken out
+# again, so each incident costs a few dict updates however long the history and however many operators there are,
+# instead of a groupby over the whole history per window.
+# A window is anomalous when its incidents (or casualties) are well above what the history of the same state,
+# operator or cause before the window would give for a window of that length: a Poisson z-score
+# (count - expected) / sqrt(expected) of THRESHOLD or more, with at least MIN_COUNT incidents in the window.
+
+from collections import deque, namedtuple
+
+import numpy as np
+import pandas as pd
+
+import cube
+
+WINDOW = pd.Timedelta(days=91) # about a quarter
+WARM_UP = pd.Timedelta(days=365) # history needed before the windows are scored
+THRESHOLD = 3.0 # z-score of an anomalous window
+MIN_COUNT = 3 # incidents in an anomalous window, fewer are noise whatever the history
+
+# The state is the one the cube uses (the operator's for the transmission data), the operator is its OPERATOR_ID
+DIMENSIONS = ['state', 'operator', 'cause']
+
+# A window that became anomalous, when and how far above its history
+Alert = namedtuple('Alert', ['time', 'dimension', 'value', 'incidents', 'expected_incidents',
+                             'casualties', 'expected_casualties', 'z'])
+
+
+def events(frames):
+    '''The incidents of frames ({dataset name: incident frame}) as one event frame in time order.
+
+    The columns are time, the DIMENSIONS, operator_name and casualties, the incidents without a LOCAL_DATETIME are left out.
+    '''
+    parts = []
+    for name, df in frames.items():
+        parts.append(pd.DataFrame({
+            'time': df['LOCAL_DATETIME'].to_numpy(),
+            'state': df[cube.STATE_COLUMNS[name]].astype(object).to_numpy(),
+            'operator': df['OPERATOR_ID'].to_numpy(),
+            'operator_name': df['NAME'].astype(object).to_numpy(),
+            'cause': df['CAUSE'].astype(object).to_numpy(),
+            'casualties': (df['FATAL'].to_numpy(dtype='int64') + df['INJURE'].to_numpy(dtype='int64')),
+        }))
+    df = pd.concat(parts, ignore_index=True).dropna(subset=['time'])
+    return df.sort_values('time', kind='stable', ignore_index=True)
+
+
+def _z(count, expected):
+    # the variance of a Poisson count is its mean, at least one so a key without history needs a few incidents
+    return (count - expected) / np.sqrt(max(expected, 1.0))
+
+
+class _Key:
+    '''The window and the history before it of one state, operator or cause.'''
+
+    __slots__ = ['incidents', 'casualties', 'past_incidents', 'past_casualties', 'anomalous']
+
+    def __init__(self):
+        self.incidents = self.casualties = self.past_incidents = self.past_casualties = 0
+        self.anomalous = False
+
+
+class TrendStream:
+    '''Sliding window counts and casualties per value of the DIMENSIONS, updated one incident at a time.
+
+    push() takes the incidents in time order, the windows always end at the last incident pushed. The windows that
+    become anomalous are recorded in alerts as they happen.
+    '''
+
+    def __init__(self, window=WINDOW, threshold=THRESHOLD, min_count=MIN_COUNT, warm_up=WARM_UP):
+        self.window = window
+        self.threshold = threshold
+        self.min_count = min_count
+        self.warm_up = warm_up
+        self.start = None # time of the first incident
+        self.time = None # time of the last incident
+        self.keys = {} # (dimension, value): _Key
+        self.labels = {} # (dimension, value): display name, e.g. the operator name of an OPERATOR_ID
+        self.alerts = []
+        self._window = deque() # (time, keys, casualties) of the incidents in the window
+        self._casualties = 0 # in the window, of all the incidents
+        self._series = [] # (time, incidents, casualties) in the window after each incident
+
+    def _history(self):
+        # days of history before the window, None during the warm up
+        history = self.time - self.window - self.start
+        return history / pd.Timedelta(days=1) if history >= self.warm_up else None
+
+    def _expected(self, key, history):
+        # incidents and casualties the history of the key gives for a window
+        scale = self.window / pd.Timedelta(days=1) / history
+        return key.past_incidents * scale, key.past_casualties * scale
+
+    def _check(self, name, key):
+        history = self._history()
+        if history is None:
+            return
+        expected_incidents, expected_casualties = self._expected(key, history)
+        z = max(_z(key.incidents, expected_incidents), _z(key.casualties, expected_casualties))
+        anomalous = key.incidents >= self.min_count and z >= self.threshold
+        if anomalous and not key.anomalous:
+            self.alerts.append(Alert(self.time, name[0], name[1], key.incidents, expected_incidents,
+                                     key.casualties, expected_casualties, z))
+        key.anomalous = anomalous
+
+    def push(self, time, values, casualties=0):
+        '''Adds an incident at time with its values ({dimension: value}, a missing value is left out).'''
+        if self.time is not None and time < self.time:
+            raise ValueError('incidents must be pushed in time order, %s is before %s' % (time, self.time))
+        if self.start is None:
+            self.start = time
+        self.time = time
+        # the incidents that fell out of the window go into the history of their keys
+        while self._window and self._window[0][0] <= time - self.window:
+            _, names, old_casualties = self._window.popleft()
+            self._casualties -= old_casualties
+            for name in names:
+                key = self.keys[name]
+                key.incidents -= 1
+                key.casualties -= old_casualties
+                key.past_incidents += 1
+                key.past_casualties += old_casualties
+                self._check(name, key)
+        names = tuple((dim, value) for dim, value in values.items() if not pd.isna(value))
+        self._window.append((time, names, casualties))
+        self._casualties += casualties
+        for name in names:
+            key = self.keys.get(name)
+            if key is None:
+                key = self.keys[name] = _Key()
+            key.incidents += 1
+            key.casualties += casualties
+            self._check(name, key)
+        self._series.append((time, len(self._window), self._casualties))
+
+    def series(self):
+        '''Incidents and casualties of all the incidents in the window, after each incident.'''
+        return pd.DataFrame(self._series, columns=['time', 'incidents', 'casualties'])
+
+    def current(self, dimension=None, anomalous_only=False):
+        '''The windows ending at the last incident, of one dimension or all of them, the highest z-score first.'''
+        history = self._history()
+        rows = []
+        for name, key in self.keys.items():
+            if not key.incidents or dimension and name[0] != dimension:
+                continue
+            if history is None:
+                expected_incidents = expected_casualties = z = np.nan
+            else:
+                expected_incidents, expected_casualties = self._expected(key, history)
+                z = max(_z(key.incidents, expected_incidents), _z(key.casualties, expected_casualties))
+            rows.append((name[0], self.labels.get(name, name[1]), key.incidents, expected_incidents, key.casualties,
+                         expected_casualties, key.casualties / key.incidents, z,
+                         key.incidents >= self.min_count and z >= self.threshold))
+        windows = pd.DataFrame(rows, columns=['dimension', 'value', 'incidents', 'expected_incidents', 'casualties',
+                                              'expected_casualties', 'casualty_rate', 'z', 'anomalous'])
+        if anomalous_only:
+            windows = windows[windows['anomalous']]
+        return windows.sort_values('z', ascending=False, ignore_index=True)
+
+    def alerts_frame(self):
+        '''The alerts with the display names of their values.'''
+        alerts = pd.DataFrame(self.alerts, columns=Alert._fields)
+        alerts['value'] = [self.labels.get((dim, value), value) for dim, value in zip(alerts['dimension'], alerts['value'])]
+        return alerts
+
+
+def replay(frames, **options):
+    '''TrendStream with all the incidents of frames ({dataset name: incident frame}) pushed in time order.'''
+    stream = TrendStream(**options)
+    df = events(frames)
+    for row in df.itertuples(index=False):
+        stream.labels[('operator', row.operator)] = '%s (%s)' % (row.operator_name, row.operator)
+        stream.push(row.time, {dim: getattr(row, dim) for dim in DIMENSIONS}, row.casualties)
+    return stream